@@ -4,7 +4,10 @@
 # This extension requires at least version 1.0-0ubuntu2 of the
 # python-nautilus package.
 #
-# To install copy captain-nemo.py to ~/.local/share/nautilus-python/extensions/
+# To install copy captain-nemo.py and the nemo_ops directory to
+# ~/.local/share/nautilus-python/extensions/
+# nemo_ops is a package and not a module, so that Nautilus doesn't import
+# it at startup.
 #
 # The following keyboard shorcuts are (re)defined to their orthodox meanings.
 #
@@ -23,19 +26,43 @@
 # As can be seen from the above table for most redefined operations there
 # exist commonly used alternatives.
 #
-# In addition this extension defined the following keyboard shortcut:
-#   Ctrl+G - open a git client in the current directory
+# In addition this extension defined the following keyboard shortcuts:
+#   Ctrl+G       - open a git client in the current directory
+#   Shift+F8     - permanently delete selected files/directories
+#   Space        - calculate the size of selected directories
+#   Ctrl+Shift+S - synchronize the other panel with the active one
+#   Alt+F7       - find files in the current directory
 # Also the Compare... item is added to the context menu when two items are
 # selected.
 
-import contextlib
+import atexit
+import bisect
+import collections
+import importlib
 import logging
 import os
-import subprocess
 import sys
-import traceback
-import urllib
-from gi.repository import Nautilus, GObject, Gtk, GConf
+import threading
+import time
+from gi.repository import Nautilus, GLib, GObject, Gtk
+
+# A module that is imported on first use. Nautilus loads extensions at
+# startup, so modules and typelibs that are only needed by some commands
+# are imported lazily to keep them off the startup path.
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module == None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, name)
+
+urllib = LazyModule('urllib')
+nemo_ops = LazyModule('nemo_ops')
+Gio = LazyModule('gi.repository.Gio')
+GConf = LazyModule('gi.repository.GConf')
 
 DIFF = 'meld'
 GIT_CLIENT = 'gitg'
@@ -44,10 +71,76 @@ EDITOR = 'gedit'
 ACCEL_FILE_NAME = os.path.join(os.path.dirname(__file__), "captain_nemo.accel")
 DEBUG = False
 SHOW_EXTRA_PANE = False
+# Copy, move and delete files with the native engines in nemo_ops instead
+# of the Nautilus menu items.
+NATIVE_FILE_OPERATIONS = True
+# Compare directories natively showing the differences in a list instead of
+# opening them in the diff tool.
+NATIVE_DIR_COMPARE = True
+# Maximum number of errors shown when a file operation is done.
+MAX_SHOWN_ERRORS = 10
+# Finish window setup and load accelerators after the window is shown.
+DEFER_WINDOW_SETUP = True
+# Delay in milliseconds before saving changed accelerators.
+SAVE_DELAY = 500
+# Maximum number of rows shown for a search in the keyboard shortcuts dialog.
+MAX_SEARCH_RESULTS = 1000
+# Number of buckets in the latency histograms of handlers.
+HISTOGRAM_BUCKETS = 24
+# Handlers that take at least this number of seconds are recorded as stalls.
+STALL_THRESHOLD = 0.05
+# Maximum number of recorded stalls.
+MAX_STALLS = 100
+# File the metrics are written to at exit or None.
+METRICS_FILE = None
+# Path of the Unix socket the metrics are served on or None.
+METRICS_SOCKET = None
+# Maximum number of cached URI to path conversions.
+MAX_URI_CACHE = 100000
+# Number of bytes of the argument size limit reserved for safety.
+ARG_MAX_MARGIN = 4096
+# Percentage of the inotify watches of the user (max_user_watches) that
+# may be used to monitor directories of file indexes. The watches are
+# shared with Nautilus and other programs, and GLib doesn't report running
+# out of them.
+INDEX_MONITOR_SHARE = 10
+# Number of inotify watches assumed if max_user_watches cannot be read.
+DEFAULT_INOTIFY_WATCHES = 8192
+# Number of directory monitors added in one idle callback.
+INDEX_MONITOR_BATCH = 100
+# Delay in milliseconds before saving a file index changed by monitors.
+INDEX_SAVE_DELAY = 5000
+
+# Returns the children of a widget. The submenu of a menu item is treated
+# as its child if visit_submenu is true.
+def get_children(widget, visit_submenu=True):
+    children = []
+    if isinstance(widget, Gtk.Container):
+        children = widget.get_children()
+    if visit_submenu and isinstance(widget, Gtk.MenuItem):
+        submenu = widget.get_submenu()
+        if submenu != None:
+            children.append(submenu)
+    return children
 
 # This class allows depth-first traversal of a widget tree using an iterator.
+# The traversal uses an explicit stack, so the cost per widget doesn't depend
+# on the tree depth. It can be restricted with the following arguments:
+#   name      - only yield widgets with this name (or any of these names)
+#   cls       - only yield instances of this type (or tuple of types)
+#   max_depth - don't descend below this depth
+#   limit     - stop after yielding this many widgets
+#   prune     - don't descend into widgets for which this predicate is true
 class walk:
-    def __init__(self, top, visit_submenu=True):
+    def __init__(self, top, visit_submenu=True, name=None, cls=None,
+                 max_depth=None, limit=None, prune=None):
+        if name != None and not isinstance(name, (tuple, list, set, frozenset)):
+            name = (name,)
+        self._names = frozenset(name) if name != None else None
+        self._cls = cls
+        self._max_depth = max_depth
+        self._limit = limit
+        self._prune = prune
         self._generator = self._walk(top)
         self._visit_submenu = visit_submenu
         self._skip_children = False
@@ -63,21 +156,130 @@ class walk:
     def skip_children(self):
         self._skip_children = True
 
-    def _walk(self, widget):
-        if widget == None: return
-        yield widget
-        if self._skip_children:
-            self._skip_children = False
+    def _walk(self, top):
+        if top == None: return
+        names, cls = self._names, self._cls
+        max_depth, limit, prune = self._max_depth, self._limit, self._prune
+        count = 0
+        stack = [(top, 0)]
+        while stack:
+            widget, depth = stack.pop()
+            self._depth = depth
+            if (names == None or widget.get_name() in names) and \
+               (cls == None or isinstance(widget, cls)):
+                yield widget
+                count += 1
+                if limit != None and count >= limit:
+                    return
+                if self._skip_children:
+                    self._skip_children = False
+                    continue
+            if max_depth != None and depth >= max_depth:
+                continue
+            if prune != None and prune(widget):
+                continue
+            children = get_children(widget, self._visit_submenu)
+            depth += 1
+            for child in reversed(children):
+                stack.append((child, depth))
+
+# This class maintains a map from widget names to widgets in a widget tree.
+# The map is built in a single traversal and kept up to date by listening to
+# add/remove signals of containers so that lookups never walk the tree.
+# Widget names are assumed not to change once a widget is in the tree.
+#
+# Only children added with gtk_container_add (or inserted into menu shells)
+# are picked up. Functions such as gtk_box_pack_start and gtk_paned_pack1/2
+# set the parent directly without emitting the add signal and there is no
+# signal on the parent that reports it, so widgets packed this way after
+# the index is built are not indexed until update is called for them or
+# one of their ancestors.
+class WidgetIndex:
+    def __init__(self, top):
+        self._widgets = {}
+        # Map from an indexed widget to its name, signal handlers and submenu.
+        self._entries = {}
+        self._add_tree(top)
+
+    def __contains__(self, widget):
+        return widget in self._entries
+
+    # Returns the first widget with the specified name that is an instance
+    # of cls and a descendant of ancestor if these are given.
+    def find(self, name, cls=None, ancestor=None):
+        for w in self._widgets.get(name, ()):
+            if cls != None and not isinstance(w, cls):
+                continue
+            if ancestor != None and not w.is_ancestor(ancestor):
+                continue
+            return w
+        return None
+
+    # Returns all widgets with the specified name in traversal order.
+    def find_all(self, name, cls=None):
+        return [w for w in self._widgets.get(name, ())
+                if cls == None or isinstance(w, cls)]
+
+    # Indexes widgets in the subtree of top that are not indexed yet.
+    def update(self, top):
+        self._add_tree(top)
+
+    def _add_tree(self, top):
+        for w in walk(top):
+            self._add_widget(w)
+
+    def _remove_tree(self, top):
+        for w in walk(top):
+            self._remove_widget(w)
+
+    def _add_widget(self, w):
+        if w in self._entries:
             return
-        self._depth += 1
-        if isinstance(widget, Gtk.Container):
-            for child in widget.get_children():
-                for w in self._walk(child):
-                    yield w
-        if self._visit_submenu and isinstance(widget, Gtk.MenuItem):
-            for w in self._walk(widget.get_submenu()):
-                yield w
-        self._depth -= 1
+        name = w.get_name()
+        handlers = []
+        submenu = None
+        if isinstance(w, Gtk.Container):
+            handlers.append(w.connect('add', self._on_add))
+            handlers.append(w.connect('remove', self._on_remove))
+        if isinstance(w, Gtk.MenuShell):
+            # Menu shells can get items without emitting the add signal.
+            handlers.append(w.connect('insert', self._on_insert))
+        if isinstance(w, Gtk.MenuItem):
+            handlers.append(w.connect('notify::submenu', self._on_submenu))
+            submenu = w.get_submenu()
+        self._entries[w] = [name, handlers, submenu]
+        self._widgets.setdefault(name, []).append(w)
+
+    def _remove_widget(self, w):
+        entry = self._entries.pop(w, None)
+        if entry == None:
+            return
+        name, handlers, submenu = entry
+        for h in handlers:
+            w.disconnect(h)
+        widgets = self._widgets[name]
+        widgets.remove(w)
+        if len(widgets) == 0:
+            del self._widgets[name]
+
+    def _on_add(self, container, widget):
+        self._add_tree(widget)
+
+    def _on_insert(self, menu_shell, widget, position):
+        self._add_tree(widget)
+
+    def _on_remove(self, container, widget):
+        self._remove_tree(widget)
+
+    def _on_submenu(self, item, pspec):
+        entry = self._entries.get(item)
+        if entry == None:
+            return
+        if entry[2] != None:
+            self._remove_tree(entry[2])
+        entry[2] = item.get_submenu()
+        if entry[2] != None:
+            self._add_tree(entry[2])
 
 class AccelInfo:
     def __init__(self, current, default):
@@ -87,14 +289,18 @@ class AccelInfo:
 # Map from accel path to info.
 ACCELS = {}
 
+# Returns the accelerator name currently associated with a path.
+def lookup_accel(accel_path):
+    known, entry = Gtk.AccelMap.lookup_entry(accel_path)
+    return Gtk.accelerator_name(entry.accel_key, entry.accel_mods)
+
 # Changes the accelerator associated with a path recording
 # the new value in ACCELS.
 def change_accel(accel_path, accel_name):
     key, mods = Gtk.accelerator_parse(accel_name)
     info = ACCELS.get(accel_path)
     if info == None:
-        known, entry = Gtk.AccelMap.lookup_entry(accel_path)
-        name = Gtk.accelerator_name(entry.accel_key, entry.accel_mods)
+        name = lookup_accel(accel_path)
         info = AccelInfo(name, name)
         ACCELS[accel_path] = info
     if Gtk.AccelMap.change_entry(accel_path, key, mods, True):
@@ -105,27 +311,137 @@ def change_accel(accel_path, accel_name):
 # Sets the default accelerators.
 def set_default_accels():
     for path, info in ACCELS.items():
-        key, mods = Gtk.accelerator_parse(info.default)
-        Gtk.AccelMap.change_entry(path, key, mods, True)
+        if info.current != info.default:
+            key, mods = Gtk.accelerator_parse(info.default)
+            Gtk.AccelMap.change_entry(path, key, mods, True)
     ACCELS.clear()
 
-# Loads accelerators from a file.
-def load_accels(filename):
-    set_default_accels()
+# Reads accelerators from a file into a map from accel path to info.
+def read_accels(filename):
+    accels = {}
     with open(filename) as f:
         for line in f:
             path, current, default = line.rstrip("\n").split(" ")
-            path = urllib.unquote(path)
-            key, mods = Gtk.accelerator_parse(current)
+            accels[urllib.unquote(path)] = AccelInfo(current, default)
+    return accels
+
+# Loads accelerators from a file. Only the accelerators that differ from
+# the ones in ACCELS are changed in the accelerator map.
+def load_accels(filename):
+    accels = read_accels(filename)
+    for path, info in ACCELS.items():
+        if path not in accels and info.current != info.default:
+            key, mods = Gtk.accelerator_parse(info.default)
             Gtk.AccelMap.change_entry(path, key, mods, True)
-            ACCELS[path] = AccelInfo(current, default)
+    for path, info in accels.items():
+        old_info = ACCELS.get(path)
+        if old_info == None or old_info.current != info.current:
+            key, mods = Gtk.accelerator_parse(info.current)
+            Gtk.AccelMap.change_entry(path, key, mods, True)
+    ACCELS.clear()
+    ACCELS.update(accels)
+
+# Returns the accelerator file contents for the current accelerators.
+def format_accels():
+    return "".join(["%s %s %s\n" %
+        (urllib.quote(path), info.current, info.default)
+        for path, info in ACCELS.items()])
 
 # Saves accelerators to a file.
 def save_accels(filename):
-    with open(filename, "w") as f:
-        for path, info in ACCELS.items():
-            f.write("%s %s %s\n" %
-                (urllib.quote(path), info.current, info.default))
+    nemo_ops.write_file_atomically(filename, format_accels())
+
+# Saves accelerators in the background. Changes made within SAVE_DELAY
+# milliseconds are coalesced into a single write which is done in a separate
+# thread, so the main loop never waits for the disk.
+class AccelSaver:
+    def __init__(self, filename):
+        self.filename = filename
+        self._timeout_id = None
+        self._cond = threading.Condition()
+        # Data waiting to be written or None.
+        self._pending = None
+        self._writing = False
+        self._thread = None
+
+    # Schedules saving of the accelerators.
+    def schedule(self):
+        if self._timeout_id == None:
+            self._timeout_id = GObject.timeout_add(SAVE_DELAY, self._on_timeout)
+
+    # Returns true if there are changes that are not written yet.
+    def is_pending(self):
+        with self._cond:
+            return self._timeout_id != None or \
+                   self._pending != None or self._writing
+
+    # Submits scheduled changes for writing without waiting for the delay
+    # and, if wait is true, waits until they are written.
+    def flush(self, wait=False):
+        if self._timeout_id != None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+            self._submit()
+        if wait:
+            with self._cond:
+                while self._pending != None or self._writing:
+                    self._cond.wait()
+
+    def _on_timeout(self):
+        self._timeout_id = None
+        with catch_all('AccelSaver._on_timeout'):
+            self._submit()
+        return False
+
+    def _submit(self):
+        # Take a snapshot in the main thread as ACCELS is not thread-safe.
+        data = format_accels()
+        with self._cond:
+            self._pending = data
+            if self._thread == None:
+                GObject.threads_init()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending == None:
+                    self._cond.wait()
+                data, self._pending = self._pending, None
+                self._writing = True
+            try:
+                nemo_ops.write_file_atomically(self.filename, data)
+            except:
+                logging.error(sys.exc_info()[1])
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+accel_saver = AccelSaver(ACCEL_FILE_NAME)
+atexit.register(accel_saver.flush, True)
+
+# Reloads accelerators when the accelerator file is changed, for example,
+# by another Nautilus process.
+class AccelFileMonitor:
+    def __init__(self, filename):
+        self.filename = filename
+        self.monitor = Gio.File.new_for_path(filename).monitor_file(
+            Gio.FileMonitorFlags.NONE, None)
+        self.monitor.connect('changed', self.on_changed)
+
+    def on_changed(self, monitor, file, other_file, event_type):
+        if event_type != Gio.FileMonitorEvent.CHANGES_DONE_HINT and \
+           event_type != Gio.FileMonitorEvent.CREATED:
+            return
+        with catch_all('AccelFileMonitor.on_changed'):
+            # Unsaved changes are newer than the file.
+            if accel_saver.is_pending():
+                return
+            logging.debug('reloading %s', self.filename)
+            load_accels(self.filename)
 
 if DEBUG:
     logging.basicConfig(
@@ -135,16 +451,237 @@ if DEBUG:
 def get_filename(file_info):
     return urllib.unquote(file_info.get_uri()[7:])
 
+# Returns the local path for a file URI or None for other URIs.
+def get_path_from_uri(uri):
+    if not uri.startswith('file://'):
+        return None
+    return urllib.unquote(uri[7:])
+
+# Map from URIs to local paths caching the results of get_path_from_uri.
+_uri_paths = {}
+
+# Returns the local paths for a list of URIs with None for non-file URIs.
+def get_paths_from_uris(uris):
+    if len(_uri_paths) + len(uris) > MAX_URI_CACHE:
+        _uri_paths.clear()
+    paths = []
+    for uri in uris:
+        path = _uri_paths.get(uri)
+        if path == None:
+            path = get_path_from_uri(uri)
+            if path != None:
+                _uri_paths[uri] = path
+        paths.append(path)
+    return paths
+
+# Splits args into chunks that can be passed to a program together with
+# command without exceeding the limit on the size of the arguments and
+# the environment of a new process.
+def split_args(command, args, max_size=None):
+    if max_size == None:
+        # Each string is counted with its terminating null and a pointer.
+        max_size = os.sysconf('SC_ARG_MAX') - ARG_MAX_MARGIN - sum(
+            len(k) + len(v) + 10 for k, v in os.environ.items())
+    command_size = sum(len(arg) + 9 for arg in command)
+    chunks = []
+    chunk, size = [], command_size
+    for arg in args:
+        arg_size = len(arg) + 9
+        if chunk and size + arg_size > max_size:
+            chunks.append(chunk)
+            chunk, size = [], command_size
+        chunk.append(arg)
+        size += arg_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
 def has_file_scheme(f):
     return f.get_uri_scheme() == 'file'
 
-# Catches and logs all exceptions.
-@contextlib.contextmanager
-def catch_all():
-    try:
-        yield
-    except:
-        logging.error(sys.exc_info()[1])
+# Call statistics of a handler.
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0
+        self.max_time = 0
+        # Bucket i counts calls that took less than 2**i microseconds
+        # except for the last bucket which counts all longer calls.
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    # Returns an upper bound of the duration in seconds of the given
+    # fraction of calls.
+    def percentile(self, fraction):
+        count = 0
+        for i, n in enumerate(self.histogram):
+            count += n
+            if count >= fraction * self.calls:
+                return (1 << i) / 1e6
+        return self.max_time
+
+# Timing and error metrics of the handlers run by the main loop. A handler
+# that takes at least STALL_THRESHOLD seconds blocks the main loop and is
+# recorded as a stall in a ring buffer of MAX_STALLS entries. Time spent in
+# nested main loops of modal dialogs is not counted. The metrics are only
+# accessed from the main thread.
+class Metrics:
+    def __init__(self):
+        self.handlers = {}
+        # Ring buffer of (start time, handler name, duration) tuples.
+        self.stalls = collections.deque(maxlen=MAX_STALLS)
+        # Total time spent in nested main loops.
+        self.nested_time = 0
+        self._socket = None
+
+    def record(self, name, start, duration, error):
+        stats = self.handlers.get(name)
+        if stats == None:
+            stats = self.handlers[name] = HandlerStats()
+        stats.calls += 1
+        if error:
+            stats.errors += 1
+        stats.total_time += duration
+        stats.max_time = max(stats.max_time, duration)
+        bucket = int(duration * 1e6).bit_length()
+        stats.histogram[min(bucket, HISTOGRAM_BUCKETS - 1)] += 1
+        if duration >= STALL_THRESHOLD:
+            self.stalls.append((start, name, duration))
+
+    # Runs a modal dialog excluding the time it takes from the metrics.
+    def run_dialog(self, dialog):
+        start = time.time()
+        try:
+            return dialog.run()
+        finally:
+            self.nested_time += time.time() - start
+
+    def format(self):
+        lines = ['%-40s %8s %6s %10s %10s %10s %10s' % ('handler', 'calls',
+            'errors', 'total ms', 'p50 ms', 'p99 ms', 'max ms')]
+        for name, stats in sorted(self.handlers.items()):
+            lines.append('%-40s %8d %6d %10.1f %10.1f %10.1f %10.1f' % (
+                name, stats.calls, stats.errors, stats.total_time * 1000,
+                stats.percentile(0.5) * 1000, stats.percentile(0.99) * 1000,
+                stats.max_time * 1000))
+        lines.append('')
+        lines.append('stalls:')
+        for start, name, duration in self.stalls:
+            lines.append('%s %-40s %10.1f ms' % (time.strftime(
+                '%H:%M:%S', time.localtime(start)), name, duration * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        nemo_ops.write_file_atomically(filename, self.format())
+
+    # Serves the metrics on a Unix socket: a client that connects to it
+    # receives the formatted metrics, e.g. socat - UNIX-CONNECT:<path>
+    def serve(self, path):
+        import socket
+        if os.path.exists(path):
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(1)
+        GObject.io_add_watch(
+            self._socket.fileno(), GObject.IO_IN, self._on_connection)
+
+    def _on_connection(self, fd, condition):
+        with catch_all():
+            connection = self._socket.accept()[0]
+            try:
+                connection.sendall(self.format().encode('utf-8'))
+            finally:
+                connection.close()
+        return True
+
+metrics = Metrics()
+if METRICS_FILE != None:
+    atexit.register(metrics.dump, METRICS_FILE)
+
+# Catches and logs all exceptions with their tracebacks. If a name is
+# given, the duration of the block and whether it failed are recorded in
+# metrics under that name.
+class catch_all:
+    def __init__(self, name=None):
+        self.name = name
+
+    def __enter__(self):
+        if self.name != None:
+            self.start = time.time()
+            self.nested_time = metrics.nested_time
+
+    def __exit__(self, type, value, tb):
+        if type != None:
+            logging.error('%s', value, exc_info=(type, value, tb))
+        if self.name != None:
+            duration = time.time() - self.start - \
+                       (metrics.nested_time - self.nested_time)
+            metrics.record(self.name, self.start, duration, type != None)
+        return True
+
+# Launches external programs asynchronously without blocking the main loop.
+# Children are reaped by child watches so that they don't become zombies.
+# The terminal command is read from GConf once and then updated by change
+# notifications. While a diff tool started by the launcher is running,
+# new comparisons are opened in it as tabs. The editor needs no special
+# handling because gedit hands files over to its running instance.
+class Launcher:
+    def __init__(self):
+        # Map from pids of running children to their commands.
+        self.children = {}
+        self.diff_pid = None
+        self._terminal = None
+        self._terminal_notify_id = None
+
+    # Starts a program searching for it in PATH and returns its pid.
+    def launch(self, argv, cwd=None):
+        logging.debug('launch: %s in %s', argv, cwd)
+        flags = GLib.SpawnFlags.SEARCH_PATH | \
+                GLib.SpawnFlags.DO_NOT_REAP_CHILD
+        pid = GLib.spawn_async(argv, working_directory=cwd, flags=flags)[0]
+        self.children[pid] = argv[0]
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, self.on_child_exit)
+        return pid
+
+    def on_child_exit(self, pid, status, data=None):
+        with catch_all('Launcher.on_child_exit'):
+            logging.debug('%s exited with status %d',
+                          self.children.pop(pid, None), status)
+            if pid == self.diff_pid:
+                self.diff_pid = None
+            GLib.spawn_close_pid(pid)
+
+    def launch_diff(self, left, right):
+        if self.diff_pid != None:
+            self.launch([DIFF, '--newtab', left, right])
+        else:
+            self.diff_pid = self.launch([DIFF, left, right])
+
+    def get_terminal(self):
+        if self._terminal_notify_id == None:
+            client = GConf.Client.get_default()
+            client.add_dir(os.path.dirname(TERMINAL_KEY),
+                           GConf.ClientPreloadType.PRELOAD_NONE)
+            self._terminal_notify_id = client.notify_add(
+                TERMINAL_KEY, self.on_terminal_changed, None)
+            self._terminal = client.get_string(TERMINAL_KEY)
+        return self._terminal
+
+    def on_terminal_changed(self, client, notify_id, entry, data):
+        with catch_all('Launcher.on_terminal_changed'):
+            self._terminal = client.get_string(TERMINAL_KEY)
+
+    # Starts command with args split into as many invocations as needed
+    # not to exceed the limit on the size of the arguments.
+    def launch_with_args(self, command, args, cwd=None):
+        for chunk in split_args(command, args):
+            self.launch(command + chunk, cwd)
+
+    def launch_terminal(self, cwd):
+        self.launch([self.get_terminal()], cwd)
+
+launcher = Launcher()
 
 def set_orthodox_accels():
     # Change the accelerator for the Open action from Ctrl+O to F3.
@@ -155,6 +692,59 @@ def set_orthodox_accels():
     # Change the accelerator for the New Folder action from Ctrl+Shift+N to F7.
     change_accel("<Actions>/DirViewActions/New Folder", "F7")
 
+# Case-insensitive substring index of texts identified by keys. A query of
+# at least three characters is answered by intersecting the sets of keys
+# whose texts contain each trigram of the query and checking the remaining
+# candidates. Shorter queries check all texts.
+class SearchIndex:
+    def __init__(self):
+        self._texts = {}
+        self._keys_by_trigram = {}
+
+    @staticmethod
+    def _trigrams(text):
+        return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+    def add(self, key, text):
+        self.remove(key)
+        text = text.lower()
+        self._texts[key] = text
+        for t in SearchIndex._trigrams(text):
+            keys = self._keys_by_trigram.get(t)
+            if keys == None:
+                keys = self._keys_by_trigram[t] = set()
+            keys.add(key)
+
+    def remove(self, key):
+        text = self._texts.pop(key, None)
+        if text == None:
+            return
+        for t in SearchIndex._trigrams(text):
+            keys = self._keys_by_trigram[t]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._keys_by_trigram[t]
+
+    # Returns the keys of texts containing query. If candidates are given,
+    # only these keys are checked, which is used to narrow down the results
+    # of a previous query contained in this one.
+    def search(self, query, candidates=None):
+        query = query.lower()
+        if candidates == None:
+            if len(query) < 3:
+                candidates = self._texts.keys()
+            else:
+                key_sets = []
+                for t in SearchIndex._trigrams(query):
+                    keys = self._keys_by_trigram.get(t)
+                    if keys == None:
+                        return []
+                    key_sets.append(keys)
+                key_sets.sort(key=len)
+                candidates = key_sets[0].intersection(*key_sets[1:])
+        texts = self._texts
+        return [k for k in candidates if k in texts and query in texts[k]]
+
 class KeyboardShortcutsDialog(Gtk.Dialog):
     def __init__(self, parent):
         Gtk.Dialog.__init__(self, "Keyboard Shortcuts", parent,
@@ -169,11 +759,22 @@ class KeyboardShortcutsDialog(Gtk.Dialog):
         hbox = Gtk.Box()
         content.pack_start(hbox, True, True, 0)
 
-        window = Gtk.ScrolledWindow(
-            border_width=5, shadow_type=Gtk.ShadowType.IN)
+        list_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
+            border_width=5, spacing=5)
+        hbox.pack_start(list_box, True, True, 0)
+
+        self.search_entry = Gtk.Entry(
+            placeholder_text="Search actions and keys")
+        self.search_entry.connect("changed", self.on_search_changed)
+        list_box.pack_start(self.search_entry, False, False, 0)
+
+        window = Gtk.ScrolledWindow(shadow_type=Gtk.ShadowType.IN)
         self.create_shortcut_list()
         window.add(self.view)
-        hbox.pack_start(window, True, True, 0)
+        list_box.pack_start(window, True, True, 0)
+
+        self.conflict_label = Gtk.Label(xalign=0, wrap=True)
+        list_box.pack_start(self.conflict_label, False, False, 0)
 
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
             border_width=5, spacing=10)
@@ -187,29 +788,49 @@ class KeyboardShortcutsDialog(Gtk.Dialog):
         button.connect("clicked", self.use_orthodox)
         vbox.pack_start(button, False, False, 0)
 
-    def create_shortcut_list(self):
-        self.accel_store = Gtk.TreeStore(str, str, bool)
-        self.accel_store.set_sort_column_id(0, Gtk.SortType.ASCENDING)
+        # Keep the rows in sync with the accelerator map.
+        self.accel_map = Gtk.AccelMap.get()
+        self.accel_map_handler = self.accel_map.connect(
+            "changed", self.on_accel_map_changed)
+        self.connect("destroy",
+            lambda *args: self.accel_map.disconnect(self.accel_map_handler))
 
-        iters = {}
-        def add_accel(data, accel_path, key, mods, changed):
-            label = Gtk.accelerator_get_label(key, mods)
-            split_path = accel_path.split("/")
-            parent = None
-            for i in range(len(split_path) - 1):
-                subpath = "/".join(split_path[:i + 1])
-                iter = iters.get(subpath)
-                if iter == None:
-                    iter = self.accel_store.append(
-                        parent, [split_path[i], "", False])
-                    iters[subpath] = iter
-                parent = iter
-            self.accel_store.append(parent, [split_path[-1], label, True])
+    def create_shortcut_list(self):
+        # Columns: name, key label, editable flag and accelerator path.
+        self.accel_store = Gtk.TreeStore(str, str, bool, str)
+
+        # All accelerator paths sorted once. Rows are only created for
+        # the children of expanded rows, other groups get a placeholder child
+        # so that they can be expanded.
+        self.accel_paths = []
+        # Map from (key, mods) to the set of paths using this accelerator
+        # and the reverse map used to detect conflicts.
+        self.paths_by_accel = {}
+        self.accels_by_path = {}
+        def add_accel(data, path, key, mods, changed):
+            self.accel_paths.append(path)
+            self.index_accel(path, key, mods)
         Gtk.AccelMap.foreach(None, add_accel)
+        self.accel_paths.sort()
+
+        # The search index is built on the first search.
+        self.search_index = None
+        self.search_store = Gtk.ListStore(str, str, bool, str)
+        self.search_rows = {}
+        self.last_query = None
+        self.last_results = None
+
+        # Map from accelerator path to a leaf row. Tree store iterators
+        # persist, so they remain valid when the store is resorted.
+        self.accel_rows = {}
+        self.add_accel_rows(None, "")
+        self.accel_store.set_sort_column_id(0, Gtk.SortType.ASCENDING)
 
         self.view = Gtk.TreeView(self.accel_store)
         self.view.set_rules_hint(True)
-        self.view.expand_all()
+        self.view.connect("test-expand-row", self.on_test_expand_row)
+        for row in self.accel_store:
+            self.view.expand_row(row.path, False)
 
         column = Gtk.TreeViewColumn("Action", Gtk.CellRendererText(), text=0)
         column.set_sort_column_id(0)
@@ -228,54 +849,592 @@ class KeyboardShortcutsDialog(Gtk.Dialog):
         column.set_sort_column_id(1)
         self.view.append_column(column)
 
+    # Adds rows for the children of the group with the specified accelerator
+    # path prefix. The empty prefix denotes the root.
+    def add_accel_rows(self, parent, prefix):
+        paths = self.accel_paths
+        if prefix:
+            # The descendants of prefix are in [prefix + "/", prefix + "0")
+            # because "0" follows "/" in ASCII.
+            start = len(prefix) + 1
+            i = bisect.bisect_left(paths, prefix + "/")
+            end = bisect.bisect_left(paths, prefix + "0", i)
+        else:
+            start, i, end = 0, 0, len(paths)
+        while i < end:
+            path = paths[i]
+            sep = path.find("/", start)
+            if sep < 0:
+                known, key = Gtk.AccelMap.lookup_entry(path)
+                label = Gtk.accelerator_get_label(key.accel_key, key.accel_mods)
+                self.accel_rows[path] = self.accel_store.append(
+                    parent, [path[start:], label, True, path])
+                i += 1
+                continue
+            subpath = path[:sep]
+            iter = self.accel_store.append(
+                parent, [path[start:sep], "", False, subpath])
+            self.accel_store.append(iter, ["", "", False, ""])
+            i = bisect.bisect_left(paths, subpath + "0", i)
+
+    # Replaces the placeholder child of a row being expanded with real rows.
+    def on_test_expand_row(self, view, iter, path):
+        with catch_all('KeyboardShortcutsDialog.on_test_expand_row'):
+            child = self.accel_store.iter_children(iter)
+            if child != None and self.accel_store.get_value(child, 3) == "":
+                self.add_accel_rows(iter, self.accel_store.get_value(iter, 3))
+                self.accel_store.remove(child)
+        return False
+
+    # Records the accelerator of a path in the conflict detection maps.
+    def index_accel(self, path, key, mods):
+        old_accel = self.accels_by_path.pop(path, None)
+        if old_accel != None:
+            paths = self.paths_by_accel[old_accel]
+            paths.discard(path)
+            if len(paths) == 0:
+                del self.paths_by_accel[old_accel]
+        if key == 0:
+            return
+        accel = (int(key), int(mods) & int(Gtk.accelerator_get_default_mod_mask()))
+        self.accels_by_path[path] = accel
+        paths = self.paths_by_accel.get(accel)
+        if paths == None:
+            paths = self.paths_by_accel[accel] = set()
+        paths.add(path)
+
+    # Returns the paths other than accel_path using the accelerator.
+    def find_conflicts(self, accel_path, key, mods):
+        accel = (int(key), int(mods) & int(Gtk.accelerator_get_default_mod_mask()))
+        return sorted(self.paths_by_accel.get(accel, set()) - set([accel_path]))
+
+    def get_search_text(self, path):
+        accel = self.accels_by_path.get(path)
+        if accel == None:
+            return path
+        return path + "\t" + Gtk.accelerator_get_label(*accel)
+
+    def on_search_changed(self, entry):
+        with catch_all('KeyboardShortcutsDialog.on_search_changed'):
+            query = entry.get_text().strip()
+            if not query:
+                self.last_query = self.last_results = None
+                self.view.set_model(self.accel_store)
+                return
+            if self.search_index == None:
+                self.search_index = SearchIndex()
+                for path in self.accel_paths:
+                    self.search_index.add(path, self.get_search_text(path))
+            # Results of a query are a subset of results of any its substring.
+            candidates = None
+            if self.last_query != None and self.last_query in query:
+                candidates = self.last_results
+            results = self.search_index.search(query, candidates)
+            if candidates == None:
+                results.sort()
+            self.last_query, self.last_results = query, results
+            self.search_rows = {}
+            self.view.set_model(None)
+            self.search_store.clear()
+            for path in results[:MAX_SEARCH_RESULTS]:
+                label = ""
+                accel = self.accels_by_path.get(path)
+                if accel != None:
+                    label = Gtk.accelerator_get_label(*accel)
+                self.search_rows[path] = self.search_store.append(
+                    [path, label, True, path])
+            self.view.set_model(self.search_store)
+
     # Converts tree iterator to accelerator path.
     def convert_tree_iter_to_accel_path(self, i):
-        items = []
-        while i != None:
-            items.insert(0, self.accel_store.get_value(i, 0))
-            i = self.accel_store.iter_parent(i)
-        return "/".join(items)
+        return self.view.get_model().get_value(i, 3)
 
     # Converts tree path to accelerator path.
     def convert_tree_path_to_accel_path(self, path):
         return self.convert_tree_iter_to_accel_path(
-            self.accel_store.get_iter(path))
-
-    def do_update_accel_store(self, iter):
-        while iter != None:
-            if self.accel_store.iter_has_child(iter):
-                self.do_update_accel_store(self.accel_store.iter_children(iter))
-            else:
-                known, key = Gtk.AccelMap.lookup_entry(
-                    self.convert_tree_iter_to_accel_path(iter))
-                if known:
-                    self.accel_store[iter][1] = Gtk.accelerator_get_label(
-                        key.accel_key, key.accel_mods)
-            iter = self.accel_store.iter_next(iter)
+            self.view.get_model().get_iter(path))
 
-    def update_accel_store(self):
-        self.do_update_accel_store(self.accel_store.get_iter_first())
-        save_accels(ACCEL_FILE_NAME)
+    # Updates the rows and indices of an accelerator that has been changed.
+    def on_accel_map_changed(self, accel_map, accel_path, key, mods):
+        with catch_all('KeyboardShortcutsDialog.on_accel_map_changed'):
+            label = Gtk.accelerator_get_label(key, mods)
+            iter = self.accel_rows.get(accel_path)
+            if iter != None:
+                self.accel_store[iter][1] = label
+            iter = self.search_rows.get(accel_path)
+            if iter != None:
+                self.search_store[iter][1] = label
+            self.index_accel(accel_path, key, mods)
+            if self.search_index != None:
+                self.search_index.add(
+                    accel_path, self.get_search_text(accel_path))
+                # The cached results may not include the changed path.
+                self.last_query = self.last_results = None
 
     def accel_edited(self, accel, path, key, mods, keycode):
-        with catch_all():
+        with catch_all('KeyboardShortcutsDialog.accel_edited'):
             accel_path = self.convert_tree_path_to_accel_path(path)
+            # Changing the accelerator removes it from the other paths
+            # using it unless they are locked.
+            used_by = self.find_conflicts(accel_path, key, mods)
+            old_accels = dict((p, lookup_accel(p)) for p in used_by)
             if change_accel(accel_path, Gtk.accelerator_name(key, mods)):
-                self.accel_store[path][1] = Gtk.accelerator_get_label(key, mods)
-                save_accels(ACCEL_FILE_NAME)
+                accel_saver.schedule()
+            # The index has been updated by on_accel_map_changed.
+            conflicts = self.find_conflicts(accel_path, key, mods)
+            replaced = [p for p in used_by if p not in conflicts]
+            for p in replaced:
+                if p not in ACCELS:
+                    ACCELS[p] = AccelInfo(old_accels[p], old_accels[p])
+                ACCELS[p].current = lookup_accel(p)
+            if replaced:
+                accel_saver.schedule()
+                self.conflict_label.set_markup(
+                    "<b>%s</b> was removed from %s" % (
+                    GLib.markup_escape_text(
+                        Gtk.accelerator_get_label(key, mods)),
+                    GLib.markup_escape_text(", ".join(replaced))))
+            elif conflicts:
+                self.conflict_label.set_markup(
+                    "<b>%s</b> is also used by %s" % (
+                    GLib.markup_escape_text(
+                        Gtk.accelerator_get_label(key, mods)),
+                    GLib.markup_escape_text(", ".join(conflicts))))
+            else:
+                self.conflict_label.set_text("")
 
     def use_default(self, widget):
-        with catch_all():
+        with catch_all('KeyboardShortcutsDialog.use_default'):
             set_default_accels()
-            self.update_accel_store()
+            accel_saver.schedule()
 
     def use_orthodox(self, widget):
-        with catch_all():
+        with catch_all('KeyboardShortcutsDialog.use_orthodox'):
             # Set default accelerators first to discard any changes,
             # then apply orthodox changes on top.
             set_default_accels()
             set_orthodox_accels()
-            self.update_accel_store()
+            accel_saver.schedule()
+
+# Shows the progress of a file operation job and allows cancelling it.
+class JobWindow(Gtk.Window):
+    def __init__(self, parent, title, job):
+        Gtk.Window.__init__(self, title=title, transient_for=parent,
+            border_width=10, resizable=False)
+        self.job = job
+        self.set_default_size(450, -1)
+
+        self.vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        self.add(self.vbox)
+        self.label = Gtk.Label(xalign=0, wrap=True)
+        self.vbox.pack_start(self.label, False, False, 0)
+        self.progress_bar = Gtk.ProgressBar()
+        self.vbox.pack_start(self.progress_bar, False, False, 0)
+        self.button = Gtk.Button(label="Cancel")
+        self.button.connect("clicked", self.on_button_clicked)
+        button_box = Gtk.ButtonBox(layout_style=Gtk.ButtonBoxStyle.END)
+        button_box.pack_start(self.button, False, False, 0)
+        self.vbox.pack_end(button_box, False, False, 0)
+        self.connect("destroy", lambda w: self.job.cancel())
+
+        # The job callbacks are called in a background thread.
+        job.on_progress = lambda job: GObject.idle_add(self.update)
+        job.on_done = lambda job: GObject.idle_add(self.on_done)
+        self.pulse_id = GObject.timeout_add(100, self.pulse)
+        self.show_all()
+
+    def start(self):
+        GObject.threads_init()
+        self.job.start()
+
+    def pulse(self):
+        self.progress_bar.pulse()
+        return True
+
+    def update(self):
+        with catch_all('JobWindow.update'):
+            self.label.set_text(self.job.summary())
+        return False
+
+    def on_done(self):
+        with catch_all('JobWindow.on_done'):
+            GObject.source_remove(self.pulse_id)
+            self.progress_bar.set_fraction(1)
+            text = self.job.summary()
+            logging.info(text)
+            for path, message in self.job.errors[:MAX_SHOWN_ERRORS]:
+                logging.error('%s: %s', path, message)
+                text += '\n%s: %s' % (path, message)
+            self.label.set_text(text)
+            self.button.set_label("Close")
+        return False
+
+    def on_button_clicked(self, button):
+        if self.job.finished:
+            self.destroy()
+        else:
+            self.job.cancel()
+
+# Job window with a list of results. The job thread queues results with
+# queue_result and they are added to the list by add_result in an idle
+# callback. Subclasses pass the titles of the columns, which all contain
+# strings, and handle activated rows in on_row_activated.
+class ResultsWindow(JobWindow):
+    def __init__(self, parent, title, job, columns):
+        JobWindow.__init__(self, parent, title, job)
+        self.set_resizable(True)
+        self.set_default_size(600, 400)
+        self.results_lock = threading.Lock()
+        self.queued_results = []
+
+        self.result_store = Gtk.ListStore(*[str] * len(columns))
+        view = Gtk.TreeView(self.result_store)
+        view.set_rules_hint(True)
+        for i, column_title in enumerate(columns):
+            column = Gtk.TreeViewColumn(
+                column_title, Gtk.CellRendererText(), text=i)
+            column.set_sort_column_id(i)
+            column.set_expand(i == 0)
+            view.append_column(column)
+        view.connect("row-activated", self.on_row_activated)
+        window = Gtk.ScrolledWindow(shadow_type=Gtk.ShadowType.IN)
+        window.add(view)
+        self.vbox.pack_start(window, True, True, 0)
+        self.vbox.reorder_child(window, 0)
+        window.show_all()
+
+    # Queues a result. Called in the job thread.
+    def queue_result(self, result):
+        with self.results_lock:
+            self.queued_results.append(result)
+            if len(self.queued_results) == 1:
+                GObject.idle_add(self.add_results)
+
+    def add_results(self):
+        with self.results_lock:
+            results, self.queued_results = self.queued_results, []
+        with catch_all('ResultsWindow.add_results'):
+            for result in results:
+                self.add_result(result)
+        return False
+
+    # Adds a result, which is a list of column values by default.
+    def add_result(self, result):
+        self.result_store.append(result)
+
+    def on_row_activated(self, view, path, column):
+        pass
+
+# Shows differences between two directories as they are found.
+# Activating a row with a file present in both directories opens
+# the files in the diff tool.
+class CompareWindow(ResultsWindow):
+    def __init__(self, parent, left, right):
+        self.left = left
+        self.right = right
+        job = nemo_ops.CompareJob(left, right)
+        ResultsWindow.__init__(self, parent, "Compare", job,
+                               ["Path", "Result"])
+        job.on_result = lambda job, path, result: \
+            self.queue_result([path, result])
+
+    def on_row_activated(self, view, path, column):
+        with catch_all('CompareWindow.on_row_activated'):
+            row = self.result_store[path]
+            if row[1] != nemo_ops.DIFFERENT:
+                return
+            left = os.path.join(self.left, row[0])
+            right = os.path.join(self.right, row[0])
+            if os.path.isfile(left) and os.path.isfile(right):
+                launcher.launch_diff(left, right)
+
+# Keeps a file index up to date by monitoring the indexed directories.
+# If a directory cannot be monitored or a directory with contents is moved
+# into the tree, the index is marked stale and refreshed by the next search.
+# All index monitors share the budget returned by get_max_index_monitors.
+# Monitors are added in batches in idle callbacks not to block the UI and
+# the index is not fresh until all of them are added.
+class IndexMonitor:
+    # Total number of monitored directories.
+    count = 0
+
+    def __init__(self, index):
+        self.index = index
+        # Map from relative directory paths to their monitors.
+        self.monitors = {}
+        self.save_id = None
+        # Directories waiting to be monitored.
+        self.pending = []
+        self.pending_id = None
+        # Whether the index is fresh once the pending directories are
+        # monitored.
+        self.fresh = False
+
+    # Monitors the directories in the index that are not monitored yet.
+    def update(self):
+        self.pending = [dirname for dirname in self.index.get_dirs()
+                        if dirname not in self.monitors]
+        if not self.pending:
+            return
+        self.fresh = self.index.fresh
+        self.index.fresh = False
+        if self.pending_id == None:
+            self.pending_id = GObject.idle_add(self.add_pending)
+
+    def add_pending(self):
+        with catch_all('IndexMonitor.add_pending'):
+            batch = self.pending[-INDEX_MONITOR_BATCH:]
+            del self.pending[-INDEX_MONITOR_BATCH:]
+            for dirname in batch:
+                if dirname not in self.monitors:
+                    self.add_monitor(dirname)
+            if self.pending:
+                return True
+            self.index.fresh = self.fresh
+        self.pending = []
+        self.pending_id = None
+        return False
+
+    # Marks the index stale.
+    def set_stale(self):
+        self.index.fresh = self.fresh = False
+
+    def add_monitor(self, dirname):
+        if IndexMonitor.count >= get_max_index_monitors():
+            self.set_stale()
+            return
+        try:
+            f = Gio.File.new_for_path(os.path.join(self.index.root, dirname))
+            monitor = f.monitor_directory(Gio.FileMonitorFlags.NONE, None)
+        except GLib.GError as e:
+            logging.debug('cannot monitor %s: %s', dirname, e)
+            self.set_stale()
+            return
+        monitor.connect('changed', self.on_changed, dirname)
+        self.monitors[dirname] = monitor
+        IndexMonitor.count += 1
+
+    def remove_monitors(self, path):
+        prefix = path + os.sep
+        for dirname in list(self.monitors):
+            if dirname == path or dirname.startswith(prefix):
+                self.monitors.pop(dirname).cancel()
+                IndexMonitor.count -= 1
+
+    # Stops monitoring. The index is no longer kept up to date.
+    def cancel(self):
+        for monitor in self.monitors.values():
+            monitor.cancel()
+        IndexMonitor.count -= len(self.monitors)
+        self.monitors = {}
+        if self.pending_id != None:
+            GObject.source_remove(self.pending_id)
+            self.pending = []
+            self.pending_id = None
+        self.set_stale()
+        if self.save_id != None:
+            GObject.source_remove(self.save_id)
+            self.save()
+
+    def on_changed(self, monitor, file, other_file, event_type, dirname):
+        with catch_all('IndexMonitor.on_changed'):
+            path = os.path.join(dirname, file.get_basename())
+            if event_type == Gio.FileMonitorEvent.CREATED:
+                full_path = file.get_path()
+                is_dir = os.path.isdir(full_path) and \
+                         not os.path.islink(full_path)
+                self.index.add(path, is_dir)
+                if is_dir:
+                    self.add_monitor(path)
+                    if os.listdir(full_path):
+                        self.set_stale()
+            elif event_type == Gio.FileMonitorEvent.DELETED:
+                self.index.remove(path)
+                self.remove_monitors(path)
+            else:
+                return
+            if self.save_id == None:
+                self.save_id = GObject.timeout_add(INDEX_SAVE_DELAY, self.save)
+
+    def save(self):
+        self.save_id = None
+        with catch_all('IndexMonitor.save'):
+            self.index.save()
+        return False
+
+max_index_monitors = None
+
+# Returns the maximum number of directories monitored to keep all file
+# indexes up to date.
+def get_max_index_monitors():
+    global max_index_monitors
+    if max_index_monitors == None:
+        try:
+            with open('/proc/sys/fs/inotify/max_user_watches') as f:
+                watches = int(f.read())
+        except (EnvironmentError, ValueError):
+            watches = DEFAULT_INOTIFY_WATCHES
+        max_index_monitors = watches * INDEX_MONITOR_SHARE // 100
+    return max_index_monitors
+
+# Map from the roots of file indexes to their monitors in the order of
+# their last use.
+index_monitors = collections.OrderedDict()
+
+# Monitors the directories of a file index. Monitors of the least recently
+# used other indexes are released if needed to stay within the budget.
+def monitor_index(index):
+    monitor = index_monitors.pop(index.root, None)
+    if monitor == None:
+        monitor = IndexMonitor(index)
+    index_monitors[index.root] = monitor
+    needed = len(index.get_dirs()) - len(monitor.monitors)
+    for root in list(index_monitors):
+        if IndexMonitor.count + needed <= get_max_index_monitors() or \
+           root == index.root:
+            break
+        index_monitors.pop(root).cancel()
+    monitor.update()
+
+# Shows files found in a directory tree as they are found. Activating
+# a row opens the directory containing the file in the panel the search
+# was started from.
+class FindWindow(ResultsWindow):
+    def __init__(self, parent, root, pattern, loc_entry):
+        self.root = root
+        self.loc_entry = loc_entry
+        self.index = nemo_ops.get_file_index(root)
+        # Map from paths to their rows in the result store.
+        self.rows = {}
+        job = nemo_ops.FindJob(root, pattern, self.index)
+        ResultsWindow.__init__(self, parent, "Find Files", job, ["Path"])
+        # Results are (path, found) pairs.
+        job.on_result = lambda job, path: self.queue_result((path, True))
+        job.on_removed = lambda job, path: self.queue_result((path, False))
+
+    def add_result(self, result):
+        path, found = result
+        if found:
+            self.rows[path] = self.result_store.append([path])
+        elif path in self.rows:
+            self.result_store.remove(self.rows.pop(path))
+
+    def on_done(self):
+        JobWindow.on_done(self)
+        with catch_all('FindWindow.on_done'):
+            monitor_index(self.index)
+        return False
+
+    def on_row_activated(self, view, path, column):
+        with catch_all('FindWindow.on_row_activated'):
+            location = os.path.join(self.root, self.result_store[path][0])
+            if not os.path.isdir(location):
+                location = os.path.dirname(location)
+            self.loc_entry.set_text(location)
+            self.loc_entry.emit('activate')
+            self.get_transient_for().present()
+
+# State of the two panels of a window: which of them is active and their
+# locations. The active panel is recorded from the set-focus signal of the
+# window and the locations are updated when the location entries change,
+# so actions get their panels without looking at the widget tree. The
+# active panel stays the same when the focus moves outside the panes, e.g.
+# to the toolbar.
+#
+# Panes can be added or replaced without signals on the paned widget, e.g.
+# the extra pane is packed with gtk_paned_pack2, so the panes are compared
+# with the current children of the paned widget whenever the state is used
+# and their location entries are found again with find_entry if they
+# differ. The state of a destroyed pane or entry is cleared.
+class PanelState:
+    def __init__(self, window, paned, find_entry):
+        self.paned = paned
+        self.find_entry = find_entry
+        self.panes = [None, None]
+        self.entries = [None, None]
+        self.locations = [None, None]
+        # Handlers of the signals of the panes and entries.
+        self.pane_handlers = [None, None]
+        self.entry_handlers = [None, None]
+        self.active = None
+        window.connect('set-focus', self.on_set_focus)
+        self.on_set_focus(window, window.get_focus())
+
+    # Updates the state of a panel if its pane has been replaced.
+    def update(self, index):
+        pane = self.paned.get_child2() if index else self.paned.get_child1()
+        if pane != self.panes[index]:
+            self.clear(index)
+            if pane != None:
+                self.panes[index] = pane
+                self.pane_handlers[index] = pane.connect(
+                    'destroy', self.on_pane_destroyed, index)
+        if self.entries[index] == None and self.panes[index] != None:
+            entry = self.find_entry(self.panes[index])
+            if entry != None:
+                self.entries[index] = entry
+                self.locations[index] = entry.get_text()
+                self.entry_handlers[index] = (
+                    entry.connect('changed', self.on_location_changed, index),
+                    entry.connect('destroy', self.on_entry_destroyed, index))
+
+    def clear(self, index):
+        self.clear_entry(index)
+        pane = self.panes[index]
+        if pane != None:
+            pane.disconnect(self.pane_handlers[index])
+        self.panes[index] = self.pane_handlers[index] = None
+        if self.active == index:
+            self.active = None
+
+    def clear_entry(self, index):
+        entry = self.entries[index]
+        if entry != None:
+            for handler in self.entry_handlers[index]:
+                entry.disconnect(handler)
+        self.entries[index] = self.entry_handlers[index] = None
+        self.locations[index] = None
+
+    def on_set_focus(self, window, widget):
+        self.update(0)
+        self.update(1)
+        # Find the child of the paned widget containing the focus.
+        while widget != None:
+            parent = widget.get_parent()
+            if parent == self.paned:
+                if widget == self.panes[0]:
+                    self.active = 0
+                elif widget == self.panes[1]:
+                    self.active = 1
+                return
+            widget = parent
+
+    def on_pane_destroyed(self, pane, index):
+        self.clear(index)
+
+    def on_entry_destroyed(self, entry, index):
+        self.clear_entry(index)
+
+    def on_location_changed(self, entry, index):
+        self.locations[index] = entry.get_text()
+
+    # Returns the location entries of the active and the other panel.
+    def get_entries(self):
+        self.update(0)
+        self.update(1)
+        if self.active == None:
+            return None, None
+        return self.entries[self.active], self.entries[1 - self.active]
+
+    # Returns the location of the active or, if other is true, the other
+    # panel or None.
+    def get_location(self, other=False):
+        self.update(0)
+        self.update(1)
+        if self.active == None:
+            return None
+        index = 1 - self.active if other else self.active
+        return self.locations[index]
 
 # Keyboard shortcuts dialog is global because shortcuts apply for a
 # whole application, not to a single window.
@@ -283,64 +1442,101 @@ shortcuts_dialog = None
 
 # Redefines keyboard shortcuts and adds extra widgets.
 class WindowAgent:
-    def __init__(self, window):
+    # If defer is true, only the accelerators are registered immediately and
+    # the window is explored in an idle callback or on the first keypress
+    # handled by the agent whichever comes first. This keeps the agent off
+    # the critical path of the first paint of a new window.
+    def __init__(self, window, defer=False):
+        start = time.time()
         self.window = window
         self.loc_entry1 = self.loc_entry2 = None
-        self.menubar = None
-        self.menu_items = {}
-
-        # Find the main paned widget and the menubar.
-        self.main_paned = menubar = None
-        walker = walk(window, False)
-        for w in walker:
-            name = w.get_name()
-            if name == 'NautilusToolbar':
-                p = w.get_parent()
-                while not isinstance(p, Gtk.Paned):
-                    p = p.get_parent()
-                self.main_paned = p
-                walker.skip_children()
-            if name == 'MenuBar':
-                self.menubar = w
-                walker.skip_children()
-
-        if self.main_paned != None:
-            # Find location entries.
-            self.loc_entry1 = self.find_loc_entry(self.main_paned.get_child1())
-            self.loc_entry2 = self.find_loc_entry(self.main_paned.get_child2())
-        else:
-            logging.error("main paned not found")
+        self.main_paned = self.menubar = self.widgets = self.panels = None
+        # Durations of the setup stages in seconds.
+        self.timings = {}
+        self._created = start
+        self._idle_id = None
 
         accel_group = Gtk.accel_groups_from_object(window)[0]
 
-        def connect(accel, func):
+        def connect(accel, func, needs_location=False):
+            def on_accel(*args):
+                if self.widgets == None:
+                    with catch_all('WindowAgent.discover'):
+                        self.discover()
+                if needs_location and self.loc_entry1 == None:
+                    # Let Nautilus handle the key.
+                    return False
+                return func(*args)
             key, mods = Gtk.accelerator_parse(accel)
-            accel_group.connect(key, mods, Gtk.AccelFlags.VISIBLE, func)
+            accel_group.connect(key, mods, Gtk.AccelFlags.VISIBLE, on_accel)
 
         connect('F4', self.on_edit)
         connect('F5', self.on_copy)
         connect('F6', self.on_move)
         connect('F8', self.on_delete)
+        if NATIVE_FILE_OPERATIONS:
+            connect('<Shift>F8', self.on_delete_permanently)
+            connect('space', self.on_dir_size)
+            connect('<Ctrl><Shift>S', self.on_synchronize, True)
+            connect('<Alt>F7', self.on_find, True)
+        # TODO: look how nautilus-open-terminal work
+        connect('<Ctrl>O', self.on_terminal, True)
+        connect('<Ctrl>G', self.on_git, True)
+
+        self._draw_handler = window.connect('draw', self.on_first_draw)
+        window.connect('destroy', self.on_destroy)
+        if defer:
+            self._idle_id = GObject.idle_add(
+                self.on_idle, priority=GObject.PRIORITY_LOW)
+        self.timings['setup'] = time.time() - start
+        if not defer:
+            self.discover()
+
+    # Explores the window, adds extra widgets and menu items.
+    # Does nothing if this has already been done.
+    def discover(self):
+        if self.widgets != None:
+            return
+        start = time.time()
+        if self._idle_id != None:
+            GObject.source_remove(self._idle_id)
+            self._idle_id = None
+        window = self.window
+
+        # Index the window widgets and find the main paned widget and
+        # the menubar.
+        self.widgets = WidgetIndex(window)
+        toolbar = self.widgets.find('NautilusToolbar')
+        if toolbar != None:
+            p = toolbar.get_parent()
+            while not isinstance(p, Gtk.Paned):
+                p = p.get_parent()
+            self.main_paned = p
+        self.menubar = self.widgets.find('MenuBar')
 
-        if self.loc_entry1 != None:
-            # TODO: look how nautilus-open-terminal work
-            connect('<Ctrl>O', self.on_terminal)
-            connect('<Ctrl>G', self.on_git)
+        if self.main_paned != None:
+            # Find location entries.
+            self.loc_entry1 = self.find_loc_entry(self.main_paned.get_child1())
+            self.loc_entry2 = self.find_loc_entry(self.main_paned.get_child2())
+            self.panels = PanelState(
+                window, self.main_paned, self.find_loc_entry)
         else:
+            logging.error("main paned not found")
+
+        if self.loc_entry1 == None:
             logging.error("location entry not found")
 
         if self.menubar != None:
-            for w in walk(self.menubar):
-                name = w.get_name()
-                if SHOW_EXTRA_PANE and name == 'Show Hide Extra Pane':
-                    w.activate()
-                elif name == 'Edit':
-                    item = Gtk.MenuItem(
-                        "_Keyboard Shortcuts...", use_underline=True)
-                    w.add(item)
-                    item.show()
-                    item.connect('activate',
-                        self.show_keyboard_shortcuts_dialog)
+            if SHOW_EXTRA_PANE:
+                item = self.widgets.find('Show Hide Extra Pane', Gtk.MenuItem)
+                if item != None:
+                    item.activate()
+            for menu in self.widgets.find_all('Edit', Gtk.Menu):
+                item = Gtk.MenuItem(
+                    "_Keyboard Shortcuts...", use_underline=True)
+                menu.add(item)
+                item.show()
+                item.connect('activate', self.show_keyboard_shortcuts_dialog)
         else:
             logging.error("menu bar not found")
 
@@ -355,34 +1551,51 @@ class WindowAgent:
             paned.pack2(inspector, False, False)
             paned.show()
             window.add(paned)
+        self.timings['discovery'] = time.time() - start
+        logging.debug('discovery: %.1f ms', self.timings['discovery'] * 1000)
+
+    def on_idle(self):
+        self._idle_id = None
+        with catch_all('WindowAgent.on_idle'):
+            self.discover()
+        return False
+
+    def on_first_draw(self, window, cr):
+        window.disconnect(self._draw_handler)
+        self.timings['first_paint'] = time.time() - self._created
+        logging.debug('time to first paint: %.1f ms',
+            self.timings['first_paint'] * 1000)
+        return False
+
+    def on_destroy(self, window):
+        if self._idle_id != None:
+            GObject.source_remove(self._idle_id)
+            self._idle_id = None
 
     def get_menu_item(self, name):
-        item = self.menu_items.get(name)
-        if item == None and self.menubar != None:
-            for w in walk(self.menubar):
-                if w.get_name() == name:
-                    item = w
-                    self.menu_items[name] = item
-                    break
+        item = self.widgets.find(name, Gtk.MenuItem)
         if item != None and item.get_sensitive():
             return item
         return None
 
     def find_loc_entry(self, widget):
-        for w in walk(widget):
-            if w.get_name() == 'NautilusLocationEntry':
-                return w
-
+        entry = self.widgets.find('NautilusLocationEntry', ancestor=widget)
+        if entry == None and widget != None:
+            # The entry may have been packed without emitting the add signal.
+            self.widgets.update(widget)
+            entry = self.widgets.find('NautilusLocationEntry', ancestor=widget)
+        return entry
+
+    # Returns the URIs of the files selected in the focused list view.
     def get_selection(self):
         focus = self.window.get_focus()
-        if not isinstance(focus, Gtk.TreeView) and \
-           focus.get_parent().get_name() == 'NautilusListView':
+        if not isinstance(focus, Gtk.TreeView) or \
+           focus.get_parent().get_name() != 'NautilusListView':
             return []
-        def collect_uris(treemodel, path, iter, uris):
-            uris.append(treemodel[iter][0].get_uri())
-        uris = []
-        focus.get_selection().selected_foreach(collect_uris, uris)
-        return uris
+        # Get all selected rows in one call instead of a callback per row.
+        model, rows = focus.get_selection().get_selected_rows()
+        get_iter, get_value = model.get_iter, model.get_value
+        return [get_value(get_iter(row), 0).get_uri() for row in rows]
 
     def show_dialog(self, title, message):
         md = Gtk.MessageDialog(parent=self.window, title=title)
@@ -390,12 +1603,61 @@ class WindowAgent:
         md.set_markup(message)
         md.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
         md.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
-        result = md.run()
+        result = metrics.run_dialog(md)
         md.destroy()
         return result == Gtk.ResponseType.OK
 
+    # Asks the user to enter a line of text. Returns the text or None if
+    # the dialog is cancelled.
+    def ask_text(self, title, message):
+        md = Gtk.MessageDialog(parent=self.window, title=title)
+        md.set_property('message-type', Gtk.MessageType.QUESTION)
+        md.set_markup(message)
+        entry = Gtk.Entry(activates_default=True)
+        md.get_message_area().pack_start(entry, False, False, 0)
+        md.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        md.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        md.set_default_response(Gtk.ResponseType.OK)
+        md.show_all()
+        result = metrics.run_dialog(md)
+        text = entry.get_text()
+        md.destroy()
+        return text if result == Gtk.ResponseType.OK else None
+
+    # Returns the local paths of the selected files if native file
+    # operations can be used, None otherwise.
+    def get_selected_paths(self):
+        if not NATIVE_FILE_OPERATIONS:
+            return None
+        paths = get_paths_from_uris(self.get_selection())
+        if not paths or None in paths:
+            return None
+        return paths
+
+    # Returns the local paths of the selected files and the location of
+    # the other panel if native file operations can be used, None otherwise.
+    def get_transfer(self):
+        paths = self.get_selected_paths()
+        if paths == None:
+            return None
+        target = self.get_other_location()
+        if not target or not os.path.isabs(target):
+            return None
+        return paths, target
+
+    def run_job(self, title, job):
+        JobWindow(self.window, title, job).start()
+
     def on_copy(self, accel_group, acceleratable, keyval, modifier):
-        with catch_all():
+        with catch_all('WindowAgent.on_copy'):
+            transfer = self.get_transfer()
+            if transfer != None:
+                sources, target = transfer
+                if self.show_dialog('Copy',
+                    'Do you want to copy selected files/directories to %s?' %
+                    GLib.markup_escape_text(target)):
+                    self.run_job('Copy', nemo_ops.CopyJob(sources, target))
+                return True
             item = self.get_menu_item('Copy to next pane')
             if item != None and self.show_dialog('Copy',
                 'Do you want to copy selected files/directories?'):
@@ -403,7 +1665,15 @@ class WindowAgent:
         return True
 
     def on_move(self, accel_group, acceleratable, keyval, modifier):
-        with catch_all():
+        with catch_all('WindowAgent.on_move'):
+            transfer = self.get_transfer()
+            if transfer != None:
+                sources, target = transfer
+                if self.show_dialog('Move',
+                    'Do you want to move selected files/directories to %s?' %
+                    GLib.markup_escape_text(target)):
+                    self.run_job('Move', nemo_ops.MoveJob(sources, target))
+                return True
             item = self.get_menu_item('Move to next pane')
             if item != None and self.show_dialog('Move',
                 'Do you want to move selected files/directories?'):
@@ -411,45 +1681,117 @@ class WindowAgent:
         return True
 
     def on_delete(self, accel_group, acceleratable, keyval, modifier):
-        with catch_all():
+        with catch_all('WindowAgent.on_delete'):
+            paths = self.get_selected_paths()
+            if paths != None:
+                if self.show_dialog('Delete',
+                    'Do you want to move selected files/directories to trash?'):
+                    self.run_job('Delete', nemo_ops.TrashJob(paths))
+                return True
             item = self.get_menu_item('Trash')
             if item != None and self.show_dialog('Delete',
                 'Do you want to move selected files/directories to trash?'):
                 item.activate()
         return True
 
+    def on_delete_permanently(self, accel_group, acceleratable, keyval,
+                              modifier):
+        with catch_all('WindowAgent.on_delete_permanently'):
+            paths = self.get_selected_paths()
+            if paths != None and self.show_dialog('Delete',
+                'Do you want to <b>permanently</b> delete selected ' +
+                'files/directories?'):
+                self.run_job('Delete', nemo_ops.DeleteJob(paths))
+        return True
+
+    # Calculates the size of selected directories. The key is passed on
+    # unless the focus is in a file list with a directory selected.
+    def on_dir_size(self, accel_group, acceleratable, keyval, modifier):
+        with catch_all('WindowAgent.on_dir_size'):
+            focus = self.window.get_focus()
+            if not isinstance(focus, Gtk.TreeView):
+                return False
+            # Let the interactive search of the view get the space.
+            search_entry = focus.get_search_entry()
+            if search_entry != None and search_entry.get_mapped():
+                return False
+            paths = self.get_selected_paths()
+            if paths != None and any(os.path.isdir(p) for p in paths):
+                self.run_job('Directory Size', nemo_ops.DirSizeJob(paths))
+                return True
+        return False
+
+    # Makes the location of the other panel a copy of the location of the
+    # active panel.
+    def on_synchronize(self, accel_group, acceleratable, keyval, modifier):
+        with catch_all('WindowAgent.on_synchronize'):
+            source, target = self.get_location(), self.get_other_location()
+            if source == None or target == None:
+                return True
+            if not os.path.isabs(source) or not os.path.isabs(target) or \
+               os.path.realpath(source) == os.path.realpath(target):
+                return True
+            if self.show_dialog('Synchronize',
+                'Do you want to synchronize %s with %s?\n'
+                'Files and directories in %s that are not in %s '
+                'will be deleted.' % tuple(GLib.markup_escape_text(p)
+                    for p in (target, source, target, source))):
+                self.run_job('Synchronize', nemo_ops.SyncJob(source, target))
+        return True
+
+    def on_find(self, accel_group, acceleratable, keyval, modifier):
+        with catch_all('WindowAgent.on_find'):
+            entry = self.get_panel_entries()[0]
+            root = self.get_location()
+            if root == None or not os.path.isabs(root):
+                return True
+            pattern = self.ask_text('Find Files',
+                'Find files in %s whose names contain (wildcards * and ? '
+                'are allowed):' % GLib.markup_escape_text(root))
+            if pattern:
+                FindWindow(self.window, root, pattern, entry).start()
+        return True
+
     def on_edit(self, accel_group, acceleratable, keyval, modifier):
-        with catch_all():
+        with catch_all('WindowAgent.on_edit'):
             selection = self.get_selection()
             logging.debug("on_edit: %s", selection)
-            subprocess.Popen([EDITOR] + selection)
+            if selection:
+                launcher.launch_with_args([EDITOR], selection)
         return True
 
+    # Returns the location entries of the active and the other panel.
+    def get_panel_entries(self):
+        if self.panels == None:
+            return None, None
+        return self.panels.get_entries()
+
+    # Returns the location of the active panel or None.
     def get_location(self):
-        w = self.window.get_focus()
-        while w != None:
-            if w == self.main_paned.get_child1():
-                entry = self.loc_entry1
-                break
-            if w == self.main_paned.get_child2():
-                entry = self.loc_entry2
-                break
-            w = w.get_parent()
-        return entry.get_text()
+        if self.panels == None:
+            return None
+        return self.panels.get_location()
+
+    # Returns the location of the other (inactive) panel or None.
+    def get_other_location(self):
+        if self.panels == None:
+            return None
+        return self.panels.get_location(other=True)
 
     def on_terminal(self, accel_group, acceleratable, keyval, modifier):
-        with catch_all():
+        with catch_all('WindowAgent.on_terminal'):
             location = self.get_location()
             logging.debug('on_terminal: location=%s', location)
-            terminal = GConf.Client.get_default().get_string(TERMINAL_KEY)
-            subprocess.Popen([terminal], cwd=location)
+            if location != None:
+                launcher.launch_terminal(location)
         return True
 
     def on_git(self, accel_group, acceleratable, keyval, modifier):
-        with catch_all():
+        with catch_all('WindowAgent.on_git'):
             location = self.get_location()
             logging.debug('on_git: location=%s', location)
-            subprocess.Popen([GIT_CLIENT], cwd=location)
+            if location != None:
+                launcher.launch([GIT_CLIENT], location)
         return True
 
     def show_keyboard_shortcuts_dialog(self, widget):
@@ -457,42 +1799,65 @@ class WindowAgent:
         if shortcuts_dialog:
             shortcuts_dialog.present()
             return
-        with catch_all():
+        with catch_all('WindowAgent.show_keyboard_shortcuts_dialog'):
             shortcuts_dialog = KeyboardShortcutsDialog(self.window)
             shortcuts_dialog.show_all()
-            shortcuts_dialog.run()
+            metrics.run_dialog(shortcuts_dialog)
             shortcuts_dialog.destroy()
         shortcuts_dialog = None
+        accel_saver.flush()
 
 class WidgetProvider(GObject.GObject, Nautilus.LocationWidgetProvider):
     def __init__(self):
-        with catch_all():
+        with catch_all('WidgetProvider.__init__'):
             self._loaded_accels = False
+            self._accel_monitor = None
             self._window_agents = {}
+            if METRICS_SOCKET != None:
+                metrics.serve(METRICS_SOCKET)
             if DEBUG:
                 # The nautilus_debug package is only imported in DEBUG mode to
                 # avoid dependency on twisted for normal use.
-                from nautilus_debug import SSHThread
-                SSHThread(self._window_agents).start()
+                from nautilus_debug import SSHServer
+                SSHServer(self._window_agents).start()
+
+    def load_accels(self):
+        with catch_all('WidgetProvider.load_accels'):
+            self._accel_monitor = AccelFileMonitor(ACCEL_FILE_NAME)
+        with catch_all('WidgetProvider.load_accels'):
+            start = time.time()
+            load_accels(ACCEL_FILE_NAME)
+            logging.debug('load_accels: %.1f ms', (time.time() - start) * 1000)
+        return False
 
     def get_widget(self, uri, window):
-        with catch_all():
+        with catch_all('WidgetProvider.get_widget'):
             if not self._loaded_accels:
                 self._loaded_accels = True
-                load_accels(ACCEL_FILE_NAME)
+                if DEFER_WINDOW_SETUP:
+                    GObject.idle_add(
+                        self.load_accels, priority=GObject.PRIORITY_LOW)
+                else:
+                    self.load_accels()
             if uri == "x-nautilus-desktop:///":
                 return None
             agent = self._window_agents.get(window)
             if agent != None:
                 return None
             window.connect("destroy", lambda w: self._window_agents.pop(w))
-            agent = WindowAgent(window)
+            agent = WindowAgent(window, DEFER_WINDOW_SETUP)
             self._window_agents[window] = agent
         return None
 
 class CompareMenuProvider(GObject.GObject, Nautilus.MenuProvider):
-    def on_compare(self, menu, files):
-        subprocess.Popen([DIFF, get_filename(files[0]), get_filename(files[1])])
+    def on_compare(self, menu, files, window):
+        with catch_all('CompareMenuProvider.on_compare'):
+            left, right = get_filename(files[0]), get_filename(files[1])
+            if NATIVE_DIR_COMPARE and os.path.isdir(left) and \
+               os.path.isdir(right):
+                CompareWindow(window, left, right).start()
+                return
+            launcher.launch_diff(left, right)
  
     def get_file_items(self, window, files):
         if len(files) != 2: return
@@ -501,5 +1866,5 @@ class CompareMenuProvider(GObject.GObject, Nautilus.MenuProvider):
         item = Nautilus.MenuItem(
             name='SimpleMenuExtension::Compare_Files', label='Compare...',
             tip='Compare...')
-        item.connect('activate', self.on_compare, files)
+        item.connect('activate', self.on_compare, files, window)
         return [item]
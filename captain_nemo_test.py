@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
 from gi.repository import Gtk
-from captain_nemo import walk, ACCELS, change_accel, load_accels, save_accels
+from captain_nemo import walk, WidgetIndex, ACCELS, change_accel, load_accels, save_accels
+from captain_nemo import AccelSaver, SearchIndex, split_args
+from captain_nemo import catch_all, metrics
+import captain_nemo
+import os
+import time
 import unittest
 
 class WalkTest(unittest.TestCase):
@@ -69,6 +74,135 @@ class WalkTest(unittest.TestCase):
             'GtkWindow 0 GtkBox 1 GtkPaned 2 GtkButton 3 ' +
             'GtkMenuBar 2 GtkMenuItem 3 GtkAccelLabel 4 GtkMenu 4 ')
 
+    def test_name(self):
+        tree_str = ''
+        for w in walk(self.window, name=('GtkPaned', 'GtkMenu')):
+            tree_str += w.get_name() + ' '
+        self.assertEqual(tree_str, 'GtkPaned GtkMenu ')
+
+    def test_cls(self):
+        tree_str = ''
+        for w in walk(self.window, cls=Gtk.MenuShell):
+            tree_str += w.get_name() + ' '
+        self.assertEqual(tree_str, 'GtkMenuBar GtkMenu ')
+
+    def test_max_depth(self):
+        tree_str = ''
+        for w in walk(self.window, max_depth=2):
+            tree_str += w.get_name() + ' '
+        self.assertEqual(tree_str, 'GtkWindow GtkBox GtkPaned GtkMenuBar ')
+
+    def test_limit(self):
+        tree_str = ''
+        for w in walk(self.window, cls=Gtk.Container, limit=2):
+            tree_str += w.get_name() + ' '
+        self.assertEqual(tree_str, 'GtkWindow GtkBox ')
+
+    def test_prune(self):
+        tree_str = ''
+        for w in walk(self.window, prune=lambda w: isinstance(w, Gtk.Paned)):
+            tree_str += w.get_name() + ' '
+        self.assertEqual(tree_str,
+            'GtkWindow GtkBox GtkPaned ' +
+            'GtkMenuBar GtkMenuItem GtkAccelLabel GtkMenu ')
+
+    def test_deep_tree(self):
+        top = widget = Gtk.Box()
+        for i in range(5000):
+            child = Gtk.Box()
+            widget.add(child)
+            widget = child
+        walker = walk(top)
+        count = 0
+        for w in walker:
+            count += 1
+        self.assertEqual(5001, count)
+        self.assertEqual(5000, walker.depth())
+
+class WidgetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.window = Gtk.Window()
+        self.box = Gtk.Box()
+        self.button = Gtk.Button()
+        self.box.add(self.button)
+        self.menubar = Gtk.MenuBar()
+        self.menuitem = Gtk.MenuItem()
+        self.menuitem.set_name('Edit')
+        self.menubar.add(self.menuitem)
+        self.box.add(self.menubar)
+        self.window.add(self.box)
+
+    def test_find(self):
+        index = WidgetIndex(self.window)
+        self.assertEqual(self.button, index.find('GtkButton'))
+        self.assertEqual(self.menuitem, index.find('Edit', Gtk.MenuItem))
+        self.assertEqual(None, index.find('Edit', Gtk.Menu))
+        self.assertEqual(self.button,
+            index.find('GtkButton', ancestor=self.box))
+        self.assertEqual(None, index.find('GtkButton', ancestor=self.menubar))
+        self.assertEqual(None, index.find('NoSuchWidget'))
+
+    def test_add_remove(self):
+        index = WidgetIndex(self.window)
+        entry = Gtk.Entry()
+        self.box.add(entry)
+        self.assertEqual(entry, index.find('GtkEntry'))
+        self.box.remove(entry)
+        self.assertEqual(None, index.find('GtkEntry'))
+        self.assertFalse(entry in index)
+
+    def test_pack(self):
+        index = WidgetIndex(self.window)
+        entry = Gtk.Entry()
+        # Packing doesn't emit the add signal.
+        self.box.pack_start(entry, False, False, 0)
+        self.assertEqual(None, index.find('GtkEntry'))
+        index.update(self.box)
+        self.assertEqual(entry, index.find('GtkEntry'))
+
+    def test_submenu(self):
+        index = WidgetIndex(self.window)
+        menu = Gtk.Menu()
+        menu.set_name('Edit')
+        self.menuitem.set_submenu(menu)
+        self.assertEqual(menu, index.find('Edit', Gtk.Menu))
+        item = Gtk.MenuItem()
+        item.set_name('Trash')
+        menu.append(item)
+        self.assertEqual(item, index.find('Trash'))
+        self.menuitem.set_submenu(None)
+        self.assertEqual(None, index.find('Edit', Gtk.Menu))
+        self.assertEqual(None, index.find('Trash'))
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add('a', '<Actions>/DirViewActions/Open\tF3')
+        self.index.add('b', '<Actions>/DirViewActions/New Folder\tF7')
+        self.index.add('c', '<Actions>/ShellActions/Close\tCtrl+W')
+
+    def test_search(self):
+        self.assertEqual(['a', 'b'], sorted(self.index.search('dirview')))
+        self.assertEqual(['b'], self.index.search('NEW FOLDER'))
+        self.assertEqual(['c'], self.index.search('ctrl+w'))
+        self.assertEqual([], self.index.search('nothing'))
+
+    def test_short_query(self):
+        self.assertEqual(['a'], self.index.search('f3'))
+
+    def test_candidates(self):
+        self.assertEqual(['b'], self.index.search('folder', ['a', 'b']))
+        self.assertEqual([], self.index.search('folder', ['a', 'c']))
+
+    def test_update(self):
+        self.index.add('a', '<Actions>/DirViewActions/Open\tCtrl+O')
+        self.assertEqual([], self.index.search('f3'))
+        self.assertEqual(['a'], self.index.search('ctrl+o'))
+        self.index.remove('a')
+        self.assertEqual([], self.index.search('open'))
+
 TEST_ACCEL_PATH = '<Actions>/Test'
 
 class AccelTest(unittest.TestCase):
@@ -119,5 +253,63 @@ class AccelTest(unittest.TestCase):
         load_accels('test.accel')
         self.assertEqual('a', ACCELS[path].current)
 
+    def test_load_changes_only_differing_accels(self):
+        change_accel(TEST_ACCEL_PATH, 'q')
+        change_accel('<Actions>/Other', 'o')
+        save_accels('test.accel')
+        change_accel(TEST_ACCEL_PATH, 'p')
+        changed = []
+        accel_map = Gtk.AccelMap.get()
+        handler = accel_map.connect('changed',
+            lambda accel_map, path, key, mods: changed.append(path))
+        try:
+            load_accels('test.accel')
+        finally:
+            accel_map.disconnect(handler)
+        self.assertEqual([TEST_ACCEL_PATH], changed)
+        self.assertEqual('q', ACCELS[TEST_ACCEL_PATH].current)
+
+    def test_saver(self):
+        if os.path.exists('test.accel'):
+            os.remove('test.accel')
+        saver = AccelSaver('test.accel')
+        change_accel(TEST_ACCEL_PATH, 'q')
+        saver.schedule()
+        change_accel(TEST_ACCEL_PATH, 'r')
+        saver.schedule()
+        self.assertTrue(saver.is_pending())
+        saver.flush(True)
+        self.assertFalse(saver.is_pending())
+        change_accel(TEST_ACCEL_PATH, 'p')
+        load_accels('test.accel')
+        self.assertEqual('r', ACCELS[TEST_ACCEL_PATH].current)
+
+class SplitArgsTest(unittest.TestCase):
+    def test_split_args(self):
+        # Each argument takes its length plus 9 bytes.
+        self.assertEqual([['aa', 'bb'], ['cc']],
+                         split_args(['e'], ['aa', 'bb', 'cc'], 10 + 2 * 11))
+        self.assertEqual([['a' * 100]], split_args(['e'], ['a' * 100], 10))
+        self.assertEqual([], split_args(['e'], []))
+
+class MetricsTest(unittest.TestCase):
+    def test_catch_all(self):
+        with catch_all('test'):
+            pass
+        with catch_all('test'):
+            raise ValueError('test')
+        stats = metrics.handlers['test']
+        self.assertEqual(2, stats.calls)
+        self.assertEqual(1, stats.errors)
+        self.assertEqual(2, sum(stats.histogram))
+        self.assertTrue('test' in metrics.format())
+
+    def test_stall(self):
+        with catch_all('stall'):
+            time.sleep(captain_nemo.STALL_THRESHOLD)
+        self.assertEqual('stall', metrics.stalls[-1][1])
+        self.assertTrue(metrics.handlers['stall'].percentile(0.5) >=
+                        captain_nemo.STALL_THRESHOLD)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+# Measures the time it takes Nautilus to load Captain Nemo at startup:
+# importing every .py file in the extensions directory, as nautilus-python
+# does, and creating the providers of captain_nemo. Each run is done in a
+# fresh interpreter. Modules that Nautilus loads itself (gi and the
+# Nautilus, Gtk, GLib and GObject typelibs) are imported before the
+# measurement.
+#
+# Usage: python measure_startup.py [runs] [budget in ms] [extensions dir]
+#
+# The extensions directory defaults to the installed one if it contains
+# captain_nemo.py and to the source directory otherwise, where only
+# captain_nemo.py is imported because the other files are not installed.
+#
+# Prints the median time and the modules imported at startup. Exits with
+# status 1 if the median exceeds the budget or if a module that should be
+# imported lazily is imported at startup.
+
+import os
+import subprocess
+import sys
+
+RUNS = 10
+BUDGET_MS = 50
+# Modules that must not be imported at startup.
+LAZY_MODULES = ['nemo_ops', 'gi.repository.GConf', 'twisted']
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INSTALL_DIR = os.path.expanduser('~/.local/share/nautilus-python/extensions')
+
+def get_extension_modules(extension_dir):
+    if extension_dir == SOURCE_DIR:
+        return ['captain_nemo']
+    return sorted(name[:-3] for name in os.listdir(extension_dir)
+                  if name.endswith('.py'))
+
+def measure(extension_dir):
+    from gi.repository import Nautilus, GLib, GObject, Gtk
+    import time
+    before = set(sys.modules)
+    start = time.time()
+    sys.path.insert(0, extension_dir)
+    for name in get_extension_modules(extension_dir):
+        __import__(name)
+    imported = time.time()
+    import captain_nemo
+    captain_nemo.WidgetProvider()
+    captain_nemo.CompareMenuProvider()
+    end = time.time()
+    print('%f %f' % ((imported - start) * 1000, (end - start) * 1000))
+    print(' '.join(sorted(set(sys.modules) - before)))
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        measure(sys.argv[2])
+        return
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else BUDGET_MS
+    if len(sys.argv) > 3:
+        extension_dir = os.path.abspath(sys.argv[3])
+    elif os.path.exists(os.path.join(INSTALL_DIR, 'captain_nemo.py')):
+        extension_dir = INSTALL_DIR
+    else:
+        extension_dir = SOURCE_DIR
+    import_times = []
+    total_times = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable,
+            os.path.abspath(__file__), '--child', extension_dir])
+        lines = output.decode().splitlines()
+        import_time, total_time = lines[0].split()
+        import_times.append(float(import_time))
+        total_times.append(float(total_time))
+        modules = lines[1].split() if len(lines) > 1 else []
+    median = lambda values: sorted(values)[len(values) // 2]
+    print('extensions: %s' % extension_dir)
+    print('import: %.1f ms, import and registration: %.1f ms (median of %d)' %
+          (median(import_times), median(total_times), runs))
+    print('modules imported: %s' % ' '.join(modules))
+    failed = False
+    eager = [m for m in modules if m in LAZY_MODULES or
+             any(m.startswith(lazy + '.') for lazy in LAZY_MODULES)]
+    if eager:
+        print('imported at startup: %s' % ' '.join(eager))
+        failed = True
+    if median(total_times) > budget:
+        print('over budget of %.1f ms' % budget)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
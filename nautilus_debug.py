@@ -2,58 +2,182 @@
 # remote access to a Python shell running in Nautilus (manhole) and a
 # widget inspector.
 
+import logging
+import os
+import sys
+import tempfile
+import threading
 import time
 from gi.repository import GObject, Gtk
-from threading import Thread
-from twisted.internet import reactor
-from twisted.cred import portal, checkers
-from twisted.conch import manhole, manhole_ssh
-from captain_nemo import walk
-
-# A thread running an SSH server for remote access to a Python shell
-# in Nautilus. To connect to the server, use the following command:
+from captain_nemo import walk, get_children, Metrics
+
+# Sampling profiler of a thread. A background thread records the stack of
+# the profiled thread every interval seconds. Samples are aggregated by
+# stack and can be dumped in the collapsed stack format used by
+# flamegraph.pl and speedscope, one "frame;frame;...;frame count" line per
+# stack with the outermost frame first.
+class Profiler:
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        # Map from collapsed stacks to the numbers of samples.
+        self.counts = {}
+        self.samples = 0
+        self._thread = None
+        self._running = False
+
+    def start(self, interval=0.005):
+        if self._running:
+            return
+        # Let other threads run while the main loop waits.
+        GObject.threads_init()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, args=(interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread != None:
+            self._thread.join()
+            self._thread = None
+
+    def clear(self):
+        self.counts = {}
+        self.samples = 0
+
+    def _run(self, interval):
+        while self._running:
+            time.sleep(interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame == None:
+                continue
+            stack = []
+            while frame != None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                    os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    # Writes the aggregated stacks to a file and returns its name.
+    def dump(self, filename=None):
+        if filename == None:
+            filename = os.path.join(tempfile.gettempdir(),
+                'nautilus-%d.folded' % os.getpid())
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('%s %d\n' % (stack, count))
+        return filename
+
+# Measures the dispatch latency of the main loop, i.e. how late a timeout
+# scheduled every interval milliseconds is dispatched. Latencies are
+# recorded in a Metrics object, so long delays appear as stalls.
+class LatencyProbe:
+    def __init__(self):
+        self.metrics = Metrics()
+        self._source_id = None
+
+    def start(self, interval=10):
+        if self._source_id != None:
+            return
+        self._interval = interval / 1000.0
+        self._expected = time.time() + self._interval
+        self._source_id = GObject.timeout_add(interval, self._on_timeout)
+
+    def stop(self):
+        if self._source_id != None:
+            GObject.source_remove(self._source_id)
+            self._source_id = None
+
+    def _on_timeout(self):
+        now = time.time()
+        self.metrics.record('dispatch latency', self._expected,
+                            max(now - self._expected, 0), False)
+        self._expected = now + self._interval
+        return True
+
+    def report(self):
+        return self.metrics.format()
+
+# An SSH server for remote access to a Python shell in Nautilus. To connect
+# to the server, use the following command:
 #   ssh -p 2222 nemo@localhost
 # The password is "nemo".
-class SSHThread(Thread):
+#
+# The shell namespace provides commands to profile the main thread:
+#   profile_start(interval=0.005), profile_stop(), profile_clear() and
+#   profile_dump(filename=None) which returns the name of the written file;
+# and to measure the dispatch latency of the main loop:
+#   latency_start(interval=10), latency_stop() and latency_report().
+#
+# The server runs in the Nautilus main loop: Twisted is driven by the GTK 3
+# reactor which watches the server sockets with GLib, so the server doesn't
+# use any CPU time while idle.
+class SSHServer:
     def __init__(self, window_agents):
-        Thread.__init__(self)
-        # Make sure this thread is a daemon not to prevent program exit.
-        self.daemon = True
+        # Twisted is imported here not to slow down loading of the widget
+        # inspector. The reactor must be installed before it is imported.
+        from twisted.internet import gtk3reactor
+        from twisted.internet.error import ReactorAlreadyInstalledError
+        from twisted.internet._glibbase import GlibReactorBase
+        try:
+            gtk3reactor.install()
+        except ReactorAlreadyInstalledError:
+            pass
+        from twisted.internet import reactor
+        self.reactor = None
+        if not isinstance(reactor, GlibReactorBase):
+            # Other reactors are never run, so they would not service
+            # the server socket.
+            logging.error('SSH server not started: %s is installed instead '
+                          'of a GLib-based reactor', type(reactor).__name__)
+            return
+        from twisted.cred import portal, checkers
+        from twisted.conch import manhole, manhole_ssh
+        self.reactor = reactor
         realm = manhole_ssh.TerminalRealm()
+        # The server is created in the main thread which is the one profiled.
+        profiler = Profiler(threading.current_thread().ident)
+        probe = LatencyProbe()
         namespace = {
           'Gtk': Gtk,
           'walk': walk,
           'widgets': lambda: walk(iter(window_agents).next()),
           'window_agents': window_agents,
-          'window': lambda: iter(window_agents).next()
+          'window': lambda: iter(window_agents).next(),
+          'profiler': profiler,
+          'profile_start': profiler.start,
+          'profile_stop': profiler.stop,
+          'profile_clear': profiler.clear,
+          'profile_dump': profiler.dump,
+          'latency_start': probe.start,
+          'latency_stop': probe.stop,
+          'latency_report': lambda: sys.stdout.write(probe.report())
         }
         realm.chainedProtocolFactory.protocolFactory = \
             lambda _: manhole.Manhole(namespace)
         p = portal.Portal(realm)
         p.registerChecker(
             checkers.InMemoryUsernamePasswordDatabaseDontUse(nemo='nemo'))
-        reactor.listenTCP(2222, manhole_ssh.ConchFactory(p))
-        # Starting the thread is not enough because the Python interpreter
-        # is no running all the time and therefore the thread will not run
-        # too. Workaround this by using a timer to run the interpreter
-        # periodically.
-        def timer():
-            time.sleep(0.001) # Yield to other threads.
-            return True
-        GObject.timeout_add(10, timer)
+        self.factory = manhole_ssh.ConchFactory(p)
 
-    def run(self):
-        # Installing signal handlers is only allowed from the main thread.
-        reactor.run(installSignalHandlers=0)
+    # Starts the server. Returns false if it cannot be started.
+    def start(self):
+        if self.reactor == None:
+            return False
+        self.reactor.listenTCP(2222, self.factory)
+        # Nautilus runs the main loop, so the reactor is only started and
+        # not run. Installing signal handlers is left to Nautilus.
+        self.reactor.startRunning(installSignalHandlers=0)
+        return True
 
 # Widget inspector provides a view of the widget tree.
 class WidgetInspector(Gtk.Notebook):
     def __init__(self, window):
         Gtk.Notebook.__init__(self)
         self.window = window
-        self.highlight_style_provider = Gtk.CssProvider()
-        self.highlight_style_provider.load_from_data(
-            '* { background-color: #bcd5eb }')
 
         # Create popup menu.
         self.menu = Gtk.Menu()
@@ -69,8 +193,14 @@ class WidgetInspector(Gtk.Notebook):
         self.show_all()
 
     def create_widget_page(self):
-        self.property_store = Gtk.TreeStore(str, str)
-        self.highlighted_widgets = []
+        # Columns are the member name and whether the row is a member or
+        # a type. Values are fetched when rows are shown.
+        self.property_store = Gtk.TreeStore(str, bool)
+        self.inspected_widget = None
+        self.member_values = {}
+        # The highlighted widget and the handler of its draw signal.
+        self.highlighted_widget = None
+        self.highlight_handler = None
         paned = Gtk.Paned()
         paned.pack1(self.create_widget_tree(self.window))
         notebook = Gtk.Notebook()
@@ -102,10 +232,25 @@ class WidgetInspector(Gtk.Notebook):
         win.add(tree)
         return win
 
+    # Map from classes to the lists of their own members.
+    _members = {}
+    # Map from classes to their member tables, see get_member_table.
+    _member_tables = {}
+
+    # Returns the members of a class that are not members of its parent
+    # type.
     @staticmethod
     def get_members(cls):
         if cls == None:
             return []
+        members = WidgetInspector._members.get(cls)
+        if members == None:
+            members = WidgetInspector._find_members(cls)
+            WidgetInspector._members[cls] = members
+        return members
+
+    @staticmethod
+    def _find_members(cls):
         members = dir(cls)
         if cls.__gtype__.depth != 1:
             parent = cls.__gtype__.parent.pytype
@@ -118,14 +263,44 @@ class WidgetInspector(Gtk.Notebook):
                     i -= 1
         return members
 
+    # Returns a pair of a list of (type name, members) pairs for the GType
+    # ancestors of cls starting from the root type and a list of the other
+    # members of cls.
+    @staticmethod
+    def get_member_table(cls):
+        table = WidgetInspector._member_tables.get(cls)
+        if table != None:
+            return table
+        groups = []
+        members = set(dir(cls))
+        gtype = cls.__gtype__
+        while gtype.depth != 0:
+            type_members = WidgetInspector.get_members(gtype.pytype)
+            if len(type_members) != 0:
+                groups.append((gtype.name, type_members))
+                members.difference_update(type_members)
+            gtype = gtype.parent
+        groups.reverse()
+        table = (groups, sorted(members))
+        WidgetInspector._member_tables[cls] = table
+        return table
+
     def create_widget_tree(self, window):
         self.widget_tree_store = Gtk.TreeStore(str, Gtk.Widget)
         self.widget_tree = Gtk.TreeView(self.widget_tree_store)
         self.widget_tree.connect('button-press-event', \
             self.on_button_press_event)
         self.widget_tree.set_headers_visible(False)
+        self.widget_tree.connect('test-expand-row', self.on_test_expand_row)
         column = Gtk.TreeViewColumn('Widget', Gtk.CellRendererText(), text=0)
         self.widget_tree.append_column(column)
+        # Map from widgets shown in the tree to their rows and the handlers
+        # of the signals that keep their children up to date.
+        self.widget_rows = {}
+        self.widget_handlers = {}
+        # Widgets whose children have been added to the tree. Other widgets
+        # with children have a placeholder row with no widget instead.
+        self.loaded_widgets = set()
         self.on_refresh(None)
         sel = self.widget_tree.get_selection()
         sel.connect('changed', self.on_widget_selection_changed)
@@ -139,17 +314,66 @@ class WidgetInspector(Gtk.Notebook):
         tree.connect('button-press-event', self.on_button_press_event)
         tree.set_headers_visible(False)
         column = Gtk.TreeViewColumn('Property', Gtk.CellRendererText(), text=0)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(250)
+        column.set_resizable(True)
         tree.append_column(column)
-        column = Gtk.TreeViewColumn('Value', Gtk.CellRendererText(), text=1)
+        renderer = Gtk.CellRendererText()
+        column = Gtk.TreeViewColumn('Value', renderer)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(400)
+        column.set_cell_data_func(renderer, self.render_member_value)
         tree.append_column(column)
+        # Only render visible rows, so only their values are fetched.
+        tree.set_fixed_height_mode(True)
         win = Gtk.ScrolledWindow()
         win.add(tree)
         return win
 
+    def get_member_value(self, name):
+        if name == '__doc__' or name == '__gdoc__':
+            return '<string>'
+        try:
+            return str(getattr(self.inspected_widget, name))
+        except:
+            return '<error>'
+
+    def render_member_value(self, column, cell, model, it, data):
+        value = ''
+        if model[it][1]:
+            name = model[it][0]
+            value = self.member_values.get(name)
+            if value == None:
+                value = self.member_values[name] = self.get_member_value(name)
+        cell.set_property('text', value)
+
+    # Highlights a widget by drawing a translucent rectangle over it after
+    # it has been drawn. Unlike changing the style of the widget and its
+    # descendants, this doesn't depend on the size of the widget subtree.
+    def highlight(self, widget):
+        self.unhighlight()
+        self.highlighted_widget = widget
+        self.highlight_handler = widget.connect_after(
+            'draw', self.on_highlighted_widget_draw)
+        widget.queue_draw()
+
     def unhighlight(self):
-        for widget in self.highlighted_widgets:
-            widget.get_style_context().remove_provider(self.highlight_style_provider)
-        self.highlighted_widgets = []
+        widget = self.highlighted_widget
+        if widget == None:
+            return
+        widget.disconnect(self.highlight_handler)
+        widget.queue_draw()
+        self.highlighted_widget = self.highlight_handler = None
+
+    def on_highlighted_widget_draw(self, widget, cr):
+        allocation = widget.get_allocation()
+        cr.rectangle(0, 0, allocation.width, allocation.height)
+        cr.set_source_rgba(0.74, 0.84, 0.92, 0.5)
+        cr.fill_preserve()
+        cr.set_source_rgb(0.2, 0.4, 0.7)
+        cr.set_line_width(2)
+        cr.stroke()
+        return False
 
     def popup_menu(self, widget):
         self.menu.popup(None, None, None, None, 0, 0)
@@ -167,61 +391,132 @@ class WidgetInspector(Gtk.Notebook):
         if iterator == None:
             return
         widget = model[iterator][1]
+        if widget == None:
+            return
         doc = widget.__getattribute__('__doc__')
         gdoc = widget.__getattribute__('__gdoc__')
         if gdoc != doc and doc != None:
             gdoc += '\n' + '-' * 80 + '\n' + doc
         self.doc_buffer.set_text(gdoc)
-        members = set(dir(widget))
-        gtype = widget.__class__.__gtype__
-        def get_value(name):
-            try:
-                w = widget
-                return str(eval('w.' + name))
-            except:
-                return '<error>'
-        while gtype.depth != 0:
-            name = gtype.name
-            type_members = WidgetInspector.get_members(gtype.pytype)
-            gtype = gtype.parent
-            if len(type_members) == 0:
-                continue
-            parent_iter = self.property_store.prepend(None)
-            self.property_store.set_value(parent_iter, 0, name)
-            if type_members == None:
-                continue
+        self.inspected_widget = widget
+        self.member_values = {}
+        groups, members = WidgetInspector.get_member_table(widget.__class__)
+        for name, type_members in groups:
+            parent_iter = self.property_store.append(None, [name, False])
             for m in type_members:
-                members.discard(m)
-                if m == '__doc__' or m == '__gdoc__':
-                    value = '<string>'
-                else:
-                    value = get_value(m)
-                self.property_store.append(parent_iter, [m, value])
+                self.property_store.append(parent_iter, [m, True])
+        # Attributes set on the instance are not in the cached table.
+        cls = widget.__class__
+        members = members + sorted(m for m in vars(widget)
+                                   if not hasattr(cls, m))
         for m in members:
-            self.property_store.append(None, [m, get_value(m)])
-        self.unhighlight()
-        walker = walk(widget)
-        for w in walker:
-            if w == self:
-                walker.skip_children()
-                continue
-            w.get_style_context().add_provider(
-                self.highlight_style_provider,
-                Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
-            self.highlighted_widgets.append(w)
+            self.property_store.append(None, [m, True])
+        self.highlight(widget)
 
     def on_refresh(self, menuitem):
         self.unhighlight()
+        for widget in list(self.widget_rows):
+            self.disconnect_widget(widget)
         self.widget_tree_store.clear()
-        parent_iters = [None]
-        walker = walk(self.window)
-        for w in walker:
-            depth = walker.depth()
-            name = w.get_name()
-            it = self.widget_tree_store.append(parent_iters[depth], [name, w])
-            if len(parent_iters) <= depth + 1:
-                parent_iters.append(it)
-            else:
-                parent_iters[depth + 1] = it
-        self.widget_tree.expand_to_path(Gtk.TreePath('0:0:0:0'))
+        self.loaded_widgets.clear()
+        self.add_widget_row(None, self.window)
+        for path in ('0', '0:0', '0:0:0'):
+            self.widget_tree.expand_row(Gtk.TreePath(path), False)
+
+    def get_widget_children(self, widget):
+        # Don't descend into the inspector which is a part of the window.
+        if widget == self:
+            return []
+        return get_children(widget)
+
+    # Adds a row for a widget with a placeholder for its children and
+    # connects to the signals that change its children.
+    def add_widget_row(self, parent_iter, widget, position=-1):
+        store = self.widget_tree_store
+        it = store.insert(parent_iter, position, [widget.get_name(), widget])
+        self.widget_rows[widget] = it
+        if self.get_widget_children(widget):
+            store.append(it, ['', None])
+        handlers = []
+        if isinstance(widget, Gtk.Container):
+            handlers.append(widget.connect('add', self.on_widget_added))
+            handlers.append(widget.connect('remove', self.on_widget_removed))
+        if isinstance(widget, Gtk.MenuShell):
+            handlers.append(widget.connect('insert', self.on_widget_inserted))
+        if isinstance(widget, Gtk.MenuItem):
+            handlers.append(
+                widget.connect('notify::submenu', self.on_submenu_changed))
+        self.widget_handlers[widget] = handlers
+
+    def disconnect_widget(self, widget):
+        del self.widget_rows[widget]
+        for handler in self.widget_handlers.pop(widget):
+            widget.disconnect(handler)
+        self.loaded_widgets.discard(widget)
+
+    # Removes the rows below a widget row.
+    def remove_child_rows(self, it):
+        store = self.widget_tree_store
+        child = store.iter_children(it)
+        while child != None:
+            self.remove_child_rows(child)
+            widget = store[child][1]
+            if widget != None:
+                self.disconnect_widget(widget)
+            store.remove(child)
+            child = store.iter_children(it)
+
+    def load_children(self, widget):
+        it = self.widget_rows[widget]
+        self.remove_child_rows(it)
+        for child in self.get_widget_children(widget):
+            if child not in self.widget_rows:
+                self.add_widget_row(it, child)
+        self.loaded_widgets.add(widget)
+
+    # Updates the rows of the children of a widget whose children changed.
+    def update_children(self, widget):
+        it = self.widget_rows.get(widget)
+        if it == None:
+            return
+        if widget in self.loaded_widgets:
+            self.load_children(widget)
+            return
+        store = self.widget_tree_store
+        has_placeholder = store.iter_has_child(it)
+        if self.get_widget_children(widget):
+            if not has_placeholder:
+                store.append(it, ['', None])
+        elif has_placeholder:
+            store.remove(store.iter_children(it))
+
+    def on_test_expand_row(self, view, it, path):
+        widget = self.widget_tree_store[it][1]
+        if widget not in self.loaded_widgets:
+            self.load_children(widget)
+        return False
+
+    def on_widget_added(self, container, widget):
+        if container not in self.loaded_widgets:
+            self.update_children(container)
+            return
+        if widget in self.widget_rows:
+            return
+        children = self.get_widget_children(container)
+        position = children.index(widget) if widget in children else -1
+        self.add_widget_row(self.widget_rows[container], widget, position)
+
+    def on_widget_inserted(self, menu_shell, widget, position):
+        self.on_widget_added(menu_shell, widget)
+
+    def on_widget_removed(self, container, widget):
+        it = self.widget_rows.get(widget)
+        if it != None:
+            self.remove_child_rows(it)
+            self.disconnect_widget(widget)
+            self.widget_tree_store.remove(it)
+        if container not in self.loaded_widgets:
+            self.update_children(container)
 
+    def on_submenu_changed(self, item, pspec):
+        self.update_children(item)
@@ -0,0 +1,1385 @@
+# This module provides native file operations for Captain Nemo such as
+# copying files between panels. It doesn't depend on GTK: operations run
+# in background threads and report progress through callbacks which are
+# invoked from these threads.
+
+import errno
+import fnmatch
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import stat
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 with the scandir package installed.
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Number of threads used by a file operation.
+WORKERS = min(16, 2 * multiprocessing.cpu_count())
+# Size of the buffer used to copy file data.
+BUFFER_SIZE = 1024 * 1024
+# Files not larger than this size are copied in batches to reduce the
+# per-task overhead.
+SMALL_FILE_SIZE = 64 * 1024
+# Maximum number of files and bytes in a batch.
+BATCH_FILES = 64
+BATCH_BYTES = 4 * 1024 * 1024
+# Minimum interval between progress reports in seconds.
+PROGRESS_INTERVAL = 0.2
+
+# Maximum number of directory listings cached for size calculation.
+MAX_DIR_SIZE_CACHE = 100000
+# Size of the chunks in which file contents is hashed.
+HASH_CHUNK_SIZE = 1024 * 1024
+# Maximum number of file hashes kept in the hash cache.
+MAX_HASH_CACHE = 1000000
+# Directory for persistent caches.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'captain-nemo')
+# Changed files of at least this size are updated in place by writing only
+# the blocks that differ.
+DELTA_MIN_SIZE = 16 * 1024 * 1024
+# Size of the blocks compared when updating a file.
+DELTA_BLOCK_SIZE = 1024 * 1024
+# Number of files moved to trash in one task.
+TRASH_BATCH_FILES = 32
+
+# Errors indicating that a zero-copy method is not supported for a pair of
+# files, in which case the next method is tried.
+_NO_ZERO_COPY = frozenset([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+    errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF])
+
+class _DirEntry:
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        if self._lstat == None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def inode(self):
+        return self.stat(False).st_ino
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(False).st_mode)
+
+# Whether directories can be listed and files removed relative to
+# a directory descriptor avoiding path resolution for every file.
+_USE_DIR_FD = scandir != None and \
+    os.unlink in getattr(os, 'supports_dir_fd', ()) and \
+    scandir in getattr(os, 'supports_fd', ())
+
+# Iterates over directory entries. Uses os.scandir if available and falls
+# back to os.listdir which requires an extra stat call per entry.
+def iter_dir(path):
+    if scandir != None:
+        return scandir(path)
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+# Returns the modification time of a file in nanoseconds.
+def get_mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns == None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return mtime_ns
+
+# Writes data to a temporary file in the same directory and renames it to
+# filename, so that the file is never left partially written. Mode is the
+# mode in which the file is opened.
+def write_file_atomically(filename, data, mode='w'):
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix='.' + basename, dir=dirname)
+    try:
+        try:
+            permissions = os.stat(filename).st_mode & 0o7777
+        except OSError:
+            permissions = 0o644
+        os.fchmod(fd, permissions)
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, filename)
+    except:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+# Formats size in bytes for humans.
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024.0
+    if unit == 'bytes':
+        return '%d %s' % (size, unit)
+    return '%.1f %s' % (size, unit)
+
+# Copies data between file descriptors and returns the number of bytes
+# copied. Tries kernel-side copying with copy_file_range and sendfile first
+# and falls back to reading and writing through a buffer. Since files on
+# procfs, sysfs and some FUSE file systems report no data to kernel-side
+# copying, the next method is tried if nothing is copied.
+def copy_data(fd_in, fd_out):
+    copied = 0
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range != None:
+        try:
+            while True:
+                n = copy_file_range(fd_in, fd_out, 1 << 30)
+                if n == 0:
+                    if copied == 0:
+                        break
+                    return copied
+                copied += n
+        except OSError as e:
+            if copied != 0 or e.errno not in _NO_ZERO_COPY:
+                raise
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile != None:
+        try:
+            while True:
+                n = sendfile(fd_out, fd_in, None, 1 << 30)
+                if n == 0:
+                    if copied == 0:
+                        break
+                    return copied
+                copied += n
+        except OSError as e:
+            if copied != 0 or e.errno not in _NO_ZERO_COPY:
+                raise
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    with io.open(fd_in, 'rb', buffering=0, closefd=False) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return copied
+            written = 0
+            while written < n:
+                written += os.write(fd_out, view[written:n])
+            copied += n
+
+# Copies a file, a symbolic link or an empty directory with its permissions
+# and times. Never overwrites an existing file. If sync is true, file data
+# is flushed to disk before returning. Returns the number of bytes copied.
+def copy_file(src, dst, st=None, sync=False):
+    if st == None:
+        st = os.lstat(src)
+    mode = st.st_mode
+    if stat.S_ISLNK(mode):
+        os.symlink(os.readlink(src), dst)
+        return 0
+    if stat.S_ISDIR(mode):
+        os.mkdir(dst, stat.S_IMODE(mode) | stat.S_IRWXU)
+        return 0
+    if not stat.S_ISREG(mode):
+        raise OSError(errno.EINVAL, 'Unsupported file type', src)
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            stat.S_IMODE(mode))
+        try:
+            size = copy_data(fd_in, fd_out)
+            if sync:
+                os.fsync(fd_out)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    os.utime(dst, (st.st_atime, st.st_mtime))
+    return size
+
+# Base class of file operations. A job runs in a background thread started
+# by start(). It calls on_progress(job) at most every PROGRESS_INTERVAL
+# seconds and on_done(job) when finished. Both are called in a background
+# thread.
+class Job:
+    # Verb describing the operation in summaries.
+    verb = 'Processed'
+    # Whether the job processes file data and reports its size.
+    counts_bytes = True
+
+    def __init__(self):
+        self.on_progress = None
+        self.on_done = None
+        self.files = 0
+        self.bytes = 0
+        # List of (path, error message) pairs.
+        self.errors = []
+        self.cancelled = False
+        self.finished = False
+        self.start_time = self.end_time = None
+        self._lock = threading.Lock()
+        self._last_report = 0
+
+    # Starts the job in a background thread.
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # Requests the job to stop as soon as possible.
+    def cancel(self):
+        self.cancelled = True
+
+    def elapsed(self):
+        if self.start_time == None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    # Returns the number of bytes processed per second.
+    def throughput(self):
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0
+
+    # Returns the number of files processed per second.
+    def files_per_second(self):
+        elapsed = self.elapsed()
+        return self.files / elapsed if elapsed > 0 else 0
+
+    def summary(self):
+        if self.counts_bytes:
+            text = '%s %d files, %s (%s/s, %d files/s)' % (self.verb,
+                self.files, format_size(self.bytes),
+                format_size(self.throughput()), self.files_per_second())
+        else:
+            text = '%s %d files (%d files/s)' % (
+                self.verb, self.files, self.files_per_second())
+        if self.errors:
+            text += ', %d errors' % len(self.errors)
+        if self.cancelled:
+            text += ', cancelled'
+        return text
+
+    # Runs the job in the current thread.
+    def run(self):
+        self.start_time = time.time()
+        try:
+            self.do_run()
+        except Exception as e:
+            self.add_error(None, e)
+        self.end_time = time.time()
+        self.finished = True
+        if self.on_done != None:
+            self.on_done(self)
+
+    def do_run(self):
+        raise NotImplementedError
+
+    # Records progress and reports it if enough time has passed since
+    # the previous report. Can be called from any thread.
+    def add_progress(self, files, size):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+            now = time.time()
+            if now - self._last_report < PROGRESS_INTERVAL:
+                return
+            self._last_report = now
+        if self.on_progress != None:
+            self.on_progress(self)
+
+    def add_error(self, path, error):
+        if isinstance(error, EnvironmentError) and error.strerror:
+            message = error.strerror
+        else:
+            message = str(error)
+        with self._lock:
+            self.errors.append((path, message))
+
+# Copies files and directories into a target directory. Directories are
+# created by the job thread as it walks the source trees, while file data
+# is copied by a pool of threads with small files grouped into batches.
+class CopyJob(Job):
+    verb = 'Copied'
+
+    def __init__(self, sources, target_dir, workers=WORKERS):
+        Job.__init__(self)
+        self.sources = sources
+        self.target_dir = target_dir
+        self.workers = workers
+
+    def do_run(self):
+        self.copy(self.sources)
+
+    # Copies sources into the target directory. Returns the list of
+    # (source, destination, stat) tuples for the copied directories
+    # in the order of creation. The stat is None for destination
+    # directories that existed before.
+    def copy(self, sources):
+        # Directories whose times are restored after their contents is copied.
+        self._dirs = []
+        pool = ThreadPool(self.workers)
+        try:
+            batches = self._batches(sources)
+            for result in pool.imap_unordered(self._copy_batch, batches):
+                if self.cancelled:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        for src, dst, st in reversed(self._dirs):
+            if st == None:
+                continue
+            try:
+                os.chmod(dst, stat.S_IMODE(st.st_mode))
+                os.utime(dst, (st.st_atime, st.st_mtime))
+            except EnvironmentError as e:
+                self.add_error(dst, e)
+        return self._dirs
+
+    # Copies a file which is not a directory and returns its size.
+    def copy_entry(self, src, dst, st):
+        return copy_file(src, dst, st)
+
+    def _copy_batch(self, batch):
+        files = size = 0
+        for src, dst, st in batch:
+            if self.cancelled:
+                break
+            try:
+                size += self.copy_entry(src, dst, st)
+                files += 1
+            except EnvironmentError as e:
+                self.add_error(src, e)
+        self.add_progress(files, size)
+
+    # Creates target directories and generates batches of files to copy.
+    def _batches(self, sources):
+        batch = []
+        batch_size = 0
+        target_dir = os.path.realpath(self.target_dir)
+        for src in sources:
+            src = os.path.normpath(src)
+            dst = os.path.join(self.target_dir, os.path.basename(src))
+            real_src = os.path.realpath(src)
+            if target_dir == real_src or \
+               target_dir.startswith(real_src + os.sep):
+                self.add_error(src, 'Cannot copy a directory into itself')
+                continue
+            stack = [(src, dst)]
+            while stack:
+                if self.cancelled:
+                    return
+                src, dst = stack.pop()
+                try:
+                    st = os.lstat(src)
+                except EnvironmentError as e:
+                    self.add_error(src, e)
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    if st.st_size > SMALL_FILE_SIZE:
+                        yield [(src, dst, st)]
+                        continue
+                    batch.append((src, dst, st))
+                    batch_size += st.st_size
+                    if len(batch) >= BATCH_FILES or batch_size >= BATCH_BYTES:
+                        yield batch
+                        batch = []
+                        batch_size = 0
+                    continue
+                try:
+                    try:
+                        copy_file(src, dst, st)
+                        self._dirs.append((src, dst, st))
+                    except OSError as e:
+                        # Copy into an existing directory. Conflicts are
+                        # reported for the files.
+                        if e.errno != errno.EEXIST or os.path.islink(dst) or \
+                           not os.path.isdir(dst):
+                            raise
+                        self._dirs.append((src, dst, None))
+                    entries = iter_dir(src)
+                    for entry in entries:
+                        stack.append((entry.path,
+                            os.path.join(dst, entry.name)))
+                except EnvironmentError as e:
+                    self.add_error(src, e)
+        if batch:
+            yield batch
+
+# Moves files and directories into a target directory. Sources on the same
+# file system as the target are renamed which takes constant time per source
+# regardless of its size. Other sources are copied in parallel and each file
+# is removed as soon as its copy is flushed to disk and verified.
+class MoveJob(CopyJob):
+    verb = 'Moved'
+
+    def do_run(self):
+        target_dev = os.stat(self.target_dir).st_dev
+        other_fs_sources = []
+        for src in self.sources:
+            if self.cancelled:
+                return
+            src = os.path.normpath(src)
+            dst = os.path.join(self.target_dir, os.path.basename(src))
+            try:
+                if os.lstat(src).st_dev == target_dev:
+                    # Unlike rename, never replace an existing file.
+                    if os.path.lexists(dst):
+                        raise OSError(errno.EEXIST, os.strerror(errno.EEXIST))
+                    os.rename(src, dst)
+                    self.add_progress(1, 0)
+                    continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    self.add_error(src, e)
+                    continue
+            other_fs_sources.append(src)
+        if not other_fs_sources:
+            return
+        dirs = self.copy(other_fs_sources)
+        # Remove source directories which are empty after all their files
+        # have been moved.
+        for src, dst, st in reversed(dirs):
+            try:
+                os.rmdir(src)
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY or not self.errors:
+                    self.add_error(src, e)
+
+    def copy_entry(self, src, dst, st):
+        size = copy_file(src, dst, st, True)
+        if stat.S_ISREG(st.st_mode) and os.lstat(dst).st_size != st.st_size:
+            raise IOError(errno.EIO, 'Copy has a different size', dst)
+        os.unlink(src)
+        return size
+
+# Moves a file to trash using GIO.
+def trash_file(path):
+    from gi.repository import Gio
+    Gio.File.new_for_path(path).trash(None)
+
+# Moves files and directories to trash in batches processed by a pool of
+# threads.
+class TrashJob(Job):
+    verb = 'Moved to trash'
+    counts_bytes = False
+
+    def __init__(self, paths, workers=WORKERS, trash=trash_file):
+        Job.__init__(self)
+        self.paths = paths
+        self.workers = workers
+        self.trash = trash
+
+    def do_run(self):
+        batches = [self.paths[i:i + TRASH_BATCH_FILES]
+                   for i in range(0, len(self.paths), TRASH_BATCH_FILES)]
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self._trash_batch, batches):
+                if self.cancelled:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _trash_batch(self, paths):
+        count = 0
+        for path in paths:
+            if self.cancelled:
+                break
+            try:
+                self.trash(path)
+                count += 1
+            except Exception as e:
+                self.add_error(path, e)
+        self.add_progress(count, 0)
+
+# Permanently deletes files and directory trees. Directories are processed
+# in parallel one level at a time: a task lists a directory once, removes
+# its files relative to the directory descriptor and returns its
+# subdirectories. The emptied directories are removed deepest first.
+class DeleteJob(Job):
+    verb = 'Deleted'
+    counts_bytes = False
+
+    def __init__(self, paths, workers=WORKERS):
+        Job.__init__(self)
+        self.paths = paths
+        self.workers = workers
+
+    def do_run(self):
+        level = []
+        for path in self.paths:
+            path = os.path.normpath(path)
+            try:
+                if stat.S_ISDIR(os.lstat(path).st_mode):
+                    level.append(path)
+                else:
+                    os.unlink(path)
+                    self.add_progress(1, 0)
+            except EnvironmentError as e:
+                self.add_error(path, e)
+        dirs = []
+        pool = ThreadPool(self.workers)
+        try:
+            while level and not self.cancelled:
+                dirs.append(level)
+                next_level = []
+                for subdirs in pool.imap_unordered(self._empty_dir, level):
+                    next_level.extend(subdirs)
+                level = next_level
+            for level in reversed(dirs):
+                if self.cancelled:
+                    break
+                for result in pool.imap_unordered(self._remove_dir, level):
+                    pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # Removes files in a directory and returns the list of its
+    # subdirectories.
+    def _empty_dir(self, path):
+        subdirs = []
+        count = 0
+        try:
+            if _USE_DIR_FD:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    for entry in scandir(fd):
+                        if self.cancelled:
+                            break
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(os.path.join(path, entry.name))
+                            continue
+                        try:
+                            os.unlink(entry.name, dir_fd=fd)
+                            count += 1
+                        except EnvironmentError as e:
+                            self.add_error(os.path.join(path, entry.name), e)
+                finally:
+                    os.close(fd)
+            else:
+                for entry in iter_dir(path):
+                    if self.cancelled:
+                        break
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    try:
+                        os.unlink(entry.path)
+                        count += 1
+                    except EnvironmentError as e:
+                        self.add_error(entry.path, e)
+        except EnvironmentError as e:
+            self.add_error(path, e)
+        self.add_progress(count, 0)
+        return subdirs
+
+    def _remove_dir(self, path):
+        try:
+            os.rmdir(path)
+            self.add_progress(1, 0)
+        except EnvironmentError as e:
+            # Don't report directories left because of other errors.
+            if e.errno != errno.ENOTEMPTY or not self.errors:
+                self.add_error(path, e)
+
+# Summary of a directory listing used to calculate directory sizes.
+class DirInfo:
+    def __init__(self):
+        # Total size and number of files directly in the directory excluding
+        # files with multiple hard links.
+        self.size = 0
+        self.files = 0
+        self.subdirs = []
+        # List of (dev, inode, size) for files with multiple hard links.
+        self.links = []
+
+# Map from (dev, inode, mtime) of a directory to the (file names,
+# subdirectory names) in it. Since the modification time of a directory
+# changes whenever entries are added or removed, an unchanged directory is
+# not listed again. Files can be modified in place without changing the
+# directory, so only the listing is cached and the files are stat'ed on
+# each run.
+_dir_info_cache = {}
+_dir_info_cache_lock = threading.Lock()
+
+def get_dir_info(path):
+    st = os.lstat(path)
+    key = (st.st_dev, st.st_ino, get_mtime_ns(st))
+    with _dir_info_cache_lock:
+        listing = _dir_info_cache.get(key)
+    info = DirInfo()
+    if listing != None:
+        names, info.subdirs = listing
+        for name in names:
+            try:
+                add_dir_info_file(info, name, os.lstat(os.path.join(path, name)))
+            except EnvironmentError as e:
+                # Removed since the directory was listed.
+                if e.errno != errno.ENOENT:
+                    raise
+        return info
+    names = []
+    for entry in iter_dir(path):
+        entry_st = entry.stat(follow_symlinks=False)
+        if stat.S_ISDIR(entry_st.st_mode):
+            info.subdirs.append(entry.name)
+        else:
+            names.append(entry.name)
+            add_dir_info_file(info, entry.name, entry_st)
+    with _dir_info_cache_lock:
+        if len(_dir_info_cache) >= MAX_DIR_SIZE_CACHE:
+            _dir_info_cache.clear()
+        _dir_info_cache[key] = (names, info.subdirs)
+    return info
+
+def add_dir_info_file(info, name, st):
+    if stat.S_ISDIR(st.st_mode):
+        info.subdirs.append(name)
+    elif st.st_nlink > 1 and not stat.S_ISLNK(st.st_mode):
+        info.links.append((st.st_dev, st.st_ino, st.st_size))
+    else:
+        info.size += st.st_size
+        info.files += 1
+
+# Calculates the total size of files in directory trees. Directories are
+# listed in parallel one level at a time and partial totals are reported
+# as progress. Files with multiple hard links are counted once.
+class DirSizeJob(Job):
+    verb = 'Found'
+
+    def __init__(self, paths, workers=WORKERS):
+        Job.__init__(self)
+        self.paths = [os.path.normpath(p) for p in paths]
+        self.workers = workers
+        # Total sizes of paths.
+        self.sizes = [0] * len(paths)
+        self._inodes = set()
+
+    def do_run(self):
+        # List of (path, index of the root path) to process.
+        level = []
+        for i, path in enumerate(self.paths):
+            try:
+                st = os.lstat(path)
+            except EnvironmentError as e:
+                self.add_error(path, e)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                level.append((path, i))
+            else:
+                self._add_file(i, st.st_dev, st.st_ino, st.st_size,
+                               st.st_nlink > 1)
+        pool = ThreadPool(self.workers)
+        try:
+            while level and not self.cancelled:
+                next_level = []
+                for path, i, info in pool.imap_unordered(self._scan, level):
+                    if info == None:
+                        continue
+                    self.sizes[i] += info.size
+                    size, files = info.size, info.files
+                    for dev, ino, link_size in info.links:
+                        if (dev, ino) not in self._inodes:
+                            self._inodes.add((dev, ino))
+                            self.sizes[i] += link_size
+                            size += link_size
+                            files += 1
+                    for name in info.subdirs:
+                        next_level.append((os.path.join(path, name), i))
+                    self.add_progress(files, size)
+                level = next_level
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _add_file(self, i, dev, ino, size, has_links):
+        if has_links:
+            if (dev, ino) in self._inodes:
+                return
+            self._inodes.add((dev, ino))
+        self.sizes[i] += size
+        self.add_progress(1, size)
+
+    def _scan(self, item):
+        path, i = item
+        try:
+            return path, i, get_dir_info(path)
+        except EnvironmentError as e:
+            self.add_error(path, e)
+            return path, i, None
+
+    def summary(self):
+        lines = [Job.summary(self)]
+        for path, size in zip(self.paths, self.sizes):
+            lines.append('%s: %s' % (os.path.basename(path) or path,
+                                     format_size(size)))
+        return '\n'.join(lines)
+
+# Returns the SHA-1 hash of file contents. The file is memory-mapped and
+# hashed in chunks.
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(0, size, HASH_CHUNK_SIZE):
+                h.update(m[offset:offset + HASH_CHUNK_SIZE])
+        finally:
+            m.close()
+    return h.hexdigest()
+
+# Persistent cache of file hashes keyed by (dev, inode, size, mtime_ns).
+# It is loaded on first use and saved explicitly with save().
+class HashCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self._hashes = None
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._hashes != None:
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                self._hashes = pickle.load(f)
+        except Exception:
+            self._hashes = {}
+
+    # Returns the hash of a file with the specified stat, computing it
+    # if it is not in the cache.
+    def get_hash(self, path, st):
+        key = (st.st_dev, st.st_ino, st.st_size, get_mtime_ns(st))
+        with self._lock:
+            self._load()
+            h = self._hashes.get(key)
+        if h != None:
+            return h
+        h = hash_file(path)
+        with self._lock:
+            if len(self._hashes) >= MAX_HASH_CACHE:
+                self._hashes.clear()
+            self._hashes[key] = h
+            self._changed = True
+        return h
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            data = pickle.dumps(self._hashes, 2)
+            self._changed = False
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        write_file_atomically(self.filename, data, 'wb')
+
+hash_cache = HashCache(os.path.join(CACHE_DIR, 'hashes'))
+
+# Comparison results.
+LEFT_ONLY = 'left only'
+RIGHT_ONLY = 'right only'
+DIFFERENT = 'different'
+
+# Compares two directory trees. Entries are first compared by name, type,
+# size and modification time as the trees are walked. Files that have
+# the same size but different modification times are then compared by
+# hashes computed by a pool of threads. Each difference is reported as soon
+# as it is found by calling on_result(job, relative path, result) in
+# a background thread.
+class CompareJob(Job):
+    verb = 'Compared'
+
+    def __init__(self, left, right, workers=WORKERS, cache=hash_cache):
+        Job.__init__(self)
+        self.left = left
+        self.right = right
+        self.workers = workers
+        self.cache = cache
+        self.on_result = None
+        # List of (relative path, result) for different entries.
+        self.results = []
+
+    def do_run(self):
+        pool = ThreadPool(self.workers)
+        try:
+            self._compare_trees(pool)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            self.cache.save()
+
+    def _compare_trees(self, pool):
+        stack = ['']
+        while stack:
+            if self.cancelled:
+                return
+            dirname = stack.pop()
+            left = self._list(os.path.join(self.left, dirname))
+            right = self._list(os.path.join(self.right, dirname))
+            subdirs = []
+            for name in sorted(set(left) | set(right)):
+                path = os.path.join(dirname, name)
+                left_st, right_st = left.get(name), right.get(name)
+                if right_st == None:
+                    self._add_result(path, LEFT_ONLY)
+                    continue
+                if left_st == None:
+                    self._add_result(path, RIGHT_ONLY)
+                    continue
+                left_type = stat.S_IFMT(left_st.st_mode)
+                if left_type != stat.S_IFMT(right_st.st_mode):
+                    self._add_result(path, DIFFERENT)
+                elif left_type == stat.S_IFDIR:
+                    subdirs.append(path)
+                elif left_type == stat.S_IFLNK:
+                    try:
+                        if os.readlink(os.path.join(self.left, path)) != \
+                           os.readlink(os.path.join(self.right, path)):
+                            self._add_result(path, DIFFERENT)
+                    except EnvironmentError as e:
+                        self.add_error(path, e)
+                    self.add_progress(1, 0)
+                elif left_st.st_size != right_st.st_size:
+                    self._add_result(path, DIFFERENT)
+                    self.add_progress(1, 0)
+                elif get_mtime_ns(left_st) == get_mtime_ns(right_st) or \
+                     left_type != stat.S_IFREG:
+                    self.add_progress(1, 0)
+                else:
+                    pool.apply_async(self._compare_contents,
+                        (path, left_st, right_st))
+            stack.extend(reversed(subdirs))
+
+    def _list(self, path):
+        entries = {}
+        try:
+            for entry in iter_dir(path):
+                entries[entry.name] = entry.stat(follow_symlinks=False)
+        except EnvironmentError as e:
+            self.add_error(path, e)
+        return entries
+
+    def _compare_contents(self, path, left_st, right_st):
+        if self.cancelled:
+            return
+        try:
+            left_hash = self.cache.get_hash(
+                os.path.join(self.left, path), left_st)
+            right_hash = self.cache.get_hash(
+                os.path.join(self.right, path), right_st)
+            if left_hash != right_hash:
+                self._add_result(path, DIFFERENT)
+            self.add_progress(1, left_st.st_size + right_st.st_size)
+        except EnvironmentError as e:
+            self.add_error(path, e)
+
+    def _add_result(self, path, result):
+        with self._lock:
+            self.results.append((path, result))
+        if self.on_result != None:
+            self.on_result(self, path, result)
+
+# Reads up to size bytes at offset from a file descriptor.
+def _pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data = data[n:]
+            offset += n
+        return
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        data = data[os.write(fd, data):]
+
+# Updates dst to have the same contents as src by comparing the files block
+# by block and writing only the blocks that differ. Returns the number of
+# bytes written.
+def update_file(src, dst, st=None):
+    if st == None:
+        st = os.stat(src)
+    written = 0
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(dst, os.O_RDWR)
+        try:
+            offset = 0
+            while True:
+                data = _pread(fd_in, DELTA_BLOCK_SIZE, offset)
+                if not data:
+                    break
+                if _pread(fd_out, len(data), offset) != data:
+                    _pwrite(fd_out, data, offset)
+                    written += len(data)
+                offset += len(data)
+            os.ftruncate(fd_out, offset)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, (st.st_atime, st.st_mtime))
+    return written
+
+# Synchronization actions.
+NEW = 'new'
+CHANGED = 'changed'
+DELETED = 'deleted'
+
+def _list_stats(path):
+    return dict((entry.name, entry.stat(follow_symlinks=False))
+                for entry in iter_dir(path))
+
+def _is_changed(source_path, target_path, source_st, target_st):
+    if stat.S_ISLNK(source_st.st_mode):
+        return os.readlink(source_path) != os.readlink(target_path)
+    # Times are compared with a precision of one second, because copies
+    # made with float times may differ in the last digits.
+    return source_st.st_size != target_st.st_size or \
+           int(source_st.st_mtime) != int(target_st.st_mtime)
+
+# Generates actions that make the target tree a copy of the source tree as
+# (action, relative path, stat) tuples where stat is of the source entry
+# for NEW and CHANGED and of the target entry for DELETED. The trees are
+# walked lazily, so the first actions are available immediately. A new
+# directory is followed by the actions for its contents. Directories that
+# cannot be listed are reported with on_error(path, error) and skipped.
+def plan_sync(source, target, on_error=None):
+    stack = ['']
+    while stack:
+        dirname = stack.pop()
+        try:
+            source_entries = _list_stats(os.path.join(source, dirname))
+        except EnvironmentError as e:
+            if on_error != None:
+                on_error(os.path.join(source, dirname), e)
+            continue
+        try:
+            target_entries = _list_stats(os.path.join(target, dirname))
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT and on_error != None:
+                on_error(os.path.join(target, dirname), e)
+            target_entries = {}
+        subdirs = []
+        for name in sorted(source_entries):
+            path = os.path.join(dirname, name)
+            st = source_entries[name]
+            target_st = target_entries.get(name)
+            if target_st != None and \
+               stat.S_IFMT(st.st_mode) != stat.S_IFMT(target_st.st_mode):
+                yield DELETED, path, target_st
+                target_st = None
+            if stat.S_ISDIR(st.st_mode):
+                if target_st == None:
+                    yield NEW, path, st
+                subdirs.append(path)
+            elif target_st == None:
+                yield NEW, path, st
+            else:
+                try:
+                    if _is_changed(os.path.join(source, path),
+                                   os.path.join(target, path), st, target_st):
+                        yield CHANGED, path, st
+                except EnvironmentError as e:
+                    if on_error != None:
+                        on_error(path, e)
+        for name in sorted(target_entries):
+            if name not in source_entries:
+                yield DELETED, os.path.join(dirname, name), target_entries[name]
+        stack.extend(reversed(subdirs))
+
+# Makes the target directory a copy of the source directory. Files are
+# copied and updated by a pool of threads as the plan is generated. Large
+# changed files are updated in place writing only the blocks that differ,
+# other changed files are replaced atomically. If delete is false, entries
+# missing in the source are kept.
+#
+# Updating a file in place is not atomic, but the file keeps its old
+# modification time until all blocks are written, so an interrupted
+# synchronization is completed by the next one.
+class SyncJob(Job):
+    verb = 'Synchronized'
+
+    def __init__(self, source, target, delete=True, workers=WORKERS):
+        Job.__init__(self)
+        self.source = source
+        self.target = target
+        self.delete = delete
+        self.workers = workers
+        self.counts = {NEW: 0, CHANGED: 0, DELETED: 0}
+
+    def do_run(self):
+        # New directories whose times are restored at the end.
+        self._dirs = []
+        source = os.path.realpath(self.source)
+        target = os.path.realpath(self.target)
+        if source == target or target.startswith(source + os.sep) or \
+           source.startswith(target + os.sep):
+            self.add_error(self.target,
+                'Cannot synchronize a directory with itself or a directory '
+                'containing it')
+            return
+        if not os.path.lexists(self.target):
+            st = os.stat(self.source)
+            copy_file(self.source, self.target, st)
+            self._dirs.append(('', st))
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self._apply, self._actions()):
+                if self.cancelled:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        for path, st in reversed(self._dirs):
+            try:
+                target_path = os.path.join(self.target, path)
+                os.chmod(target_path, stat.S_IMODE(st.st_mode))
+                os.utime(target_path, (st.st_atime, st.st_mtime))
+            except EnvironmentError as e:
+                self.add_error(path, e)
+
+    # Generates actions applied by the pool. Directories are created and
+    # entries replaced by entries of other types here, because the actions
+    # that follow depend on them.
+    def _actions(self):
+        for action, path, st in plan_sync(
+                self.source, self.target, self.add_error):
+            if self.cancelled:
+                return
+            target_path = os.path.join(self.target, path)
+            is_dir = stat.S_ISDIR(st.st_mode)
+            try:
+                if action == DELETED:
+                    if not self.delete:
+                        continue
+                    if os.path.lexists(os.path.join(self.source, path)):
+                        self._remove(target_path, st)
+                        continue
+                elif action == NEW and is_dir:
+                    copy_file(os.path.join(self.source, path), target_path, st)
+                    self._dirs.append((path, st))
+                    self._count(action, 0)
+                    continue
+            except EnvironmentError as e:
+                self.add_error(target_path, e)
+                continue
+            yield action, path, st
+
+    def _apply(self, item):
+        action, path, st = item
+        source_path = os.path.join(self.source, path)
+        target_path = os.path.join(self.target, path)
+        try:
+            if action == DELETED:
+                self._remove(target_path, st)
+                return
+            if action == NEW:
+                self._count(action, copy_file(source_path, target_path, st))
+                return
+            if stat.S_ISREG(st.st_mode) and st.st_size >= DELTA_MIN_SIZE:
+                self._count(action, update_file(source_path, target_path, st))
+                return
+            # Replace the file with a copy made next to it.
+            dirname, name = os.path.split(target_path)
+            tmp_path = os.path.join(dirname, '.%s.nemo-sync' % name)
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            size = copy_file(source_path, tmp_path, st)
+            os.rename(tmp_path, target_path)
+            self._count(action, size)
+        except EnvironmentError as e:
+            self.add_error(target_path, e)
+
+    def _remove(self, path, st):
+        if stat.S_ISDIR(st.st_mode):
+            job = DeleteJob([path], workers=1)
+            job.run()
+            for error in job.errors:
+                self.add_error(*error)
+        else:
+            os.unlink(path)
+        self._count(DELETED, 0)
+
+    def _count(self, action, size):
+        with self._lock:
+            self.counts[action] += 1
+        self.add_progress(1, size)
+
+    def summary(self):
+        text = '%s: %d new, %d changed, %d deleted, %s written (%s/s)' % (
+            self.verb, self.counts[NEW], self.counts[CHANGED],
+            self.counts[DELETED], format_size(self.bytes),
+            format_size(self.throughput()))
+        if self.errors:
+            text += ', %d errors' % len(self.errors)
+        if self.cancelled:
+            text += ', cancelled'
+        return text
+
+# Returns a function that checks whether a file name matches a pattern.
+# Patterns with wildcards are matched with fnmatch, other patterns match
+# names containing them. Matching is case-insensitive.
+def make_matcher(pattern):
+    pattern = pattern.lower()
+    if any(c in pattern for c in '*?['):
+        match = re.compile(fnmatch.translate(pattern)).match
+        return lambda name: match(name.lower()) != None
+    return lambda name: pattern in name.lower()
+
+# Returns a path as bytes. Unicode paths are encoded the way the file
+# system functions do, so paths with undecodable names round-trip.
+def encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    fsencode = getattr(os, 'fsencode', None)
+    if fsencode != None:
+        return fsencode(path)
+    return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+# Index of file names in a directory tree stored in CACHE_DIR. It maps the
+# relative path of each directory to a dictionary from the names of its
+# entries to whether they are directories. The index is filled by FindJob
+# and can be kept up to date by calling add and remove when files are
+# created or deleted. Methods can be called from any thread.
+class FileIndex:
+    def __init__(self, root, filename=None):
+        self.root = root
+        if filename == None:
+            filename = os.path.join(CACHE_DIR, 'index',
+                hashlib.sha1(encode_path(root)).hexdigest())
+        self.filename = filename
+        # Whether the index is known to match the tree, i.e. it has been
+        # filled by a crawl and all changes since then have been recorded.
+        self.fresh = False
+        self._dirs = None
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._dirs != None:
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                root, self._dirs = pickle.load(f)
+            if root != self.root:
+                self._dirs = {}
+        except Exception:
+            self._dirs = {}
+
+    def is_empty(self):
+        with self._lock:
+            self._load()
+            return len(self._dirs) == 0
+
+    # Returns the relative paths of the indexed directories.
+    def get_dirs(self):
+        with self._lock:
+            self._load()
+            return list(self._dirs)
+
+    # Generates the relative paths of entries whose names satisfy match.
+    def search(self, match):
+        with self._lock:
+            self._load()
+            dirs = list(self._dirs.items())
+        for dirname, entries in dirs:
+            for name in list(entries):
+                if match(name):
+                    yield os.path.join(dirname, name)
+
+    # Replaces the entries of a directory.
+    def set_dir(self, dirname, entries):
+        with self._lock:
+            self._load()
+            self._dirs[dirname] = entries
+            self._changed = True
+
+    # Removes directories whose relative paths are not in dirnames.
+    def retain(self, dirnames):
+        with self._lock:
+            self._load()
+            for dirname in list(self._dirs):
+                if dirname not in dirnames:
+                    del self._dirs[dirname]
+                    self._changed = True
+
+    def add(self, path, is_dir):
+        dirname, name = os.path.split(path)
+        with self._lock:
+            self._load()
+            entries = self._dirs.get(dirname)
+            if entries == None:
+                return
+            entries[name] = is_dir
+            if is_dir and path not in self._dirs:
+                self._dirs[path] = {}
+            self._changed = True
+
+    # Removes an entry and, if it is a directory, its contents.
+    def remove(self, path):
+        dirname, name = os.path.split(path)
+        with self._lock:
+            self._load()
+            entries = self._dirs.get(dirname)
+            if entries == None or entries.pop(name, None) == None:
+                return
+            stack = [path]
+            while stack:
+                dirname = stack.pop()
+                entries = self._dirs.pop(dirname, None)
+                if entries != None:
+                    stack.extend(os.path.join(dirname, name)
+                                 for name, is_dir in entries.items() if is_dir)
+            self._changed = True
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            data = pickle.dumps((self.root, self._dirs), 2)
+            self._changed = False
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        write_file_atomically(self.filename, data, 'wb')
+
+_file_indexes = {}
+_file_indexes_lock = threading.Lock()
+
+# Returns the file index of a directory tree loading it on first use.
+def get_file_index(root):
+    root = os.path.normpath(root)
+    with _file_indexes_lock:
+        index = _file_indexes.get(root)
+        if index == None:
+            index = _file_indexes[root] = FileIndex(root)
+        return index
+
+# Finds files whose names match a pattern in a directory tree and reports
+# their relative paths with on_result(job, path) as they are found. If an
+# index is given, matches are first reported from the index. Unless the
+# index is fresh, the tree is then crawled in parallel one level at a
+# time updating the index, new matches are reported and matches that no
+# longer exist are reported with on_removed(job, path).
+class FindJob(Job):
+    verb = 'Searched'
+    counts_bytes = False
+
+    def __init__(self, root, pattern, index=None, workers=WORKERS):
+        Job.__init__(self)
+        self.root = root
+        self.pattern = pattern
+        self.index = index
+        self.workers = workers
+        self.on_result = None
+        self.on_removed = None
+        self.results = set()
+
+    def do_run(self):
+        match = make_matcher(self.pattern)
+        index = self.index
+        if index != None:
+            for path in index.search(match):
+                self._report(path)
+            if index.fresh:
+                return
+        # Relative paths of directories that have been listed.
+        listed = set()
+        found = set()
+        level = ['']
+        pool = ThreadPool(self.workers)
+        try:
+            while level and not self.cancelled:
+                next_level = []
+                for dirname, entries in pool.imap_unordered(self._scan, level):
+                    if entries == None:
+                        continue
+                    listed.add(dirname)
+                    if index != None:
+                        index.set_dir(dirname, entries)
+                    for name, is_dir in entries.items():
+                        path = os.path.join(dirname, name)
+                        if is_dir:
+                            next_level.append(path)
+                        if match(name):
+                            found.add(path)
+                            if path not in self.results:
+                                self._report(path)
+                    self.add_progress(len(entries), 0)
+                level = next_level
+        finally:
+            pool.terminate()
+            pool.join()
+        if self.cancelled:
+            return
+        # Without errors the whole tree has been listed, otherwise only
+        # matches in the listed directories are known to be removed.
+        for path in list(self.results):
+            if path not in found and \
+               (not self.errors or os.path.dirname(path) in listed):
+                self.results.discard(path)
+                if self.on_removed != None:
+                    self.on_removed(self, path)
+        if index != None:
+            # Keep the directories that could not be listed in the index.
+            if not self.errors:
+                index.retain(listed)
+                index.fresh = True
+            index.save()
+
+    def _scan(self, dirname):
+        try:
+            entries = {}
+            for entry in iter_dir(os.path.join(self.root, dirname)):
+                entries[entry.name] = entry.is_dir(follow_symlinks=False)
+            return dirname, entries
+        except EnvironmentError as e:
+            self.add_error(os.path.join(self.root, dirname), e)
+            return dirname, None
+
+    def _report(self, path):
+        self.results.add(path)
+        if self.on_result != None:
+            self.on_result(self, path)
+
+    def summary(self):
+        text = '%s %d files, %d found (%d files/s)' % (self.verb, self.files,
+            len(self.results), self.files_per_second())
+        if self.errors:
+            text += ', %d errors' % len(self.errors)
+        if self.cancelled:
+            text += ', cancelled'
+        return text
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+import nemo_ops
+from nemo_ops import CopyJob, MoveJob, TrashJob, DeleteJob, DirSizeJob
+from nemo_ops import CompareJob, HashCache, hash_file
+from nemo_ops import SyncJob, plan_sync, update_file
+from nemo_ops import FindJob, FileIndex
+from nemo_ops import copy_file, format_size
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class FileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        os.mkdir(self.src)
+        os.mkdir(self.dst)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Creates a tree with small and large files, a subdirectory and a link.
+    def make_tree(self, root):
+        os.mkdir(root)
+        write_file(os.path.join(root, 'small'), b'small')
+        write_file(os.path.join(root, 'large'),
+            b'x' * (nemo_ops.SMALL_FILE_SIZE * 3 + 1))
+        os.mkdir(os.path.join(root, 'sub'))
+        for i in range(100):
+            write_file(os.path.join(root, 'sub', str(i)), str(i).encode())
+        os.symlink('small', os.path.join(root, 'link'))
+
+    def assertSameTree(self, a, b):
+        self.assertEqual(sorted(os.listdir(a)), sorted(os.listdir(b)))
+        for name in os.listdir(a):
+            pa, pb = os.path.join(a, name), os.path.join(b, name)
+            if os.path.islink(pa):
+                self.assertEqual(os.readlink(pa), os.readlink(pb))
+            elif os.path.isdir(pa):
+                self.assertSameTree(pa, pb)
+            else:
+                self.assertEqual(read_file(pa), read_file(pb))
+                self.assertEqual(int(os.stat(pa).st_mtime),
+                                 int(os.stat(pb).st_mtime))
+
+class CopyTest(FileTestCase):
+
+    def test_format_size(self):
+        self.assertEqual('10 bytes', format_size(10))
+        self.assertEqual('1.5 KB', format_size(1536))
+        self.assertEqual('2.0 GB', format_size(2 << 30))
+
+    def test_copy_file(self):
+        src = os.path.join(self.src, 'a')
+        write_file(src, b'data')
+        os.chmod(src, 0o640)
+        dst = os.path.join(self.dst, 'a')
+        self.assertEqual(4, copy_file(src, dst))
+        self.assertEqual(b'data', read_file(dst))
+        self.assertEqual(0o640, os.stat(dst).st_mode & 0o777)
+        self.assertRaises(OSError, copy_file, src, dst)
+
+    def test_copy_proc_file(self):
+        # Files on procfs have no size and no data for kernel-side copying.
+        src = '/proc/self/status'
+        if not os.path.exists(src):
+            return
+        dst = os.path.join(self.dst, 'status')
+        self.assertTrue(copy_file(src, dst) > 0)
+        self.assertTrue(b'Name:' in read_file(dst))
+
+    def test_copy_tree(self):
+        tree = os.path.join(self.src, 'tree')
+        self.make_tree(tree)
+        job = CopyJob([tree], self.dst, workers=4)
+        job.run()
+        self.assertEqual([], job.errors)
+        self.assertTrue(job.finished)
+        self.assertEqual(103, job.files)
+        self.assertSameTree(tree, os.path.join(self.dst, 'tree'))
+
+    def test_copy_existing(self):
+        write_file(os.path.join(self.src, 'a'), b'new')
+        write_file(os.path.join(self.dst, 'a'), b'old')
+        job = CopyJob([os.path.join(self.src, 'a')], self.dst)
+        job.run()
+        self.assertEqual(1, len(job.errors))
+        self.assertEqual(b'old', read_file(os.path.join(self.dst, 'a')))
+
+    def test_copy_into_existing_dir(self):
+        tree = os.path.join(self.src, 'tree')
+        self.make_tree(tree)
+        os.makedirs(os.path.join(self.dst, 'tree', 'sub'))
+        write_file(os.path.join(self.dst, 'tree', 'sub', '1'), b'old')
+        write_file(os.path.join(self.dst, 'tree', 'other'), b'')
+        job = CopyJob([tree], self.dst)
+        job.run()
+        self.assertEqual([os.path.join(tree, 'sub', '1')],
+                         [path for path, error in job.errors])
+        self.assertEqual(102, job.files)
+        self.assertEqual(b'old',
+            read_file(os.path.join(self.dst, 'tree', 'sub', '1')))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.dst, 'tree', 'sub', '2')))
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'tree', 'other')))
+
+    def test_copy_into_itself(self):
+        job = CopyJob([self.dir], self.dst)
+        job.run()
+        self.assertEqual(1, len(job.errors))
+
+    def test_progress(self):
+        reports = []
+        write_file(os.path.join(self.src, 'a'), b'data')
+        job = CopyJob([os.path.join(self.src, 'a')], self.dst)
+        job.on_done = reports.append
+        job.start().join()
+        self.assertEqual([job], reports)
+        self.assertEqual(4, job.bytes)
+        self.assertTrue('Copied 1 files' in job.summary())
+
+class MoveTest(FileTestCase):
+
+    def test_rename(self):
+        tree = os.path.join(self.src, 'tree')
+        self.make_tree(tree)
+        inode = os.stat(tree).st_ino
+        job = MoveJob([tree], self.dst)
+        job.run()
+        self.assertEqual([], job.errors)
+        self.assertFalse(os.path.exists(tree))
+        self.assertEqual(inode, os.stat(os.path.join(self.dst, 'tree')).st_ino)
+
+    def test_no_overwrite(self):
+        write_file(os.path.join(self.src, 'a'), b'new')
+        write_file(os.path.join(self.dst, 'a'), b'old')
+        job = MoveJob([os.path.join(self.src, 'a')], self.dst)
+        job.run()
+        self.assertEqual(1, len(job.errors))
+        self.assertEqual(b'old', read_file(os.path.join(self.dst, 'a')))
+        self.assertTrue(os.path.exists(os.path.join(self.src, 'a')))
+
+    def test_copy_and_delete(self):
+        tree = os.path.join(self.src, 'tree')
+        self.make_tree(tree)
+        expected = os.path.join(self.dir, 'expected')
+        shutil.copytree(tree, expected, symlinks=True)
+        job = MoveJob([], self.dst)
+        job.copy([tree])
+        self.assertEqual([], job.errors)
+        self.assertSameTree(expected, os.path.join(self.dst, 'tree'))
+        self.assertEqual(['sub'], os.listdir(tree))
+        self.assertEqual([], os.listdir(os.path.join(tree, 'sub')))
+
+class DeleteTest(FileTestCase):
+
+    def test_delete(self):
+        tree = os.path.join(self.src, 'tree')
+        self.make_tree(tree)
+        os.makedirs(os.path.join(tree, 'a', 'b', 'c'))
+        single = os.path.join(self.src, 'single')
+        write_file(single, b'data')
+        job = DeleteJob([tree, single], workers=4)
+        job.run()
+        self.assertEqual([], job.errors)
+        self.assertEqual([], os.listdir(self.src))
+        # 103 files and 5 directories.
+        self.assertEqual(109, job.files)
+        self.assertTrue('Deleted 109 files' in job.summary())
+
+    def test_delete_missing(self):
+        job = DeleteJob([os.path.join(self.src, 'missing')])
+        job.run()
+        self.assertEqual(1, len(job.errors))
+
+    def test_trash(self):
+        trashed = []
+        def trash(path):
+            if path == 'bad':
+                raise IOError(13, 'Permission denied')
+            trashed.append(path)
+        paths = [str(i) for i in range(100)] + ['bad']
+        job = TrashJob(paths, workers=4, trash=trash)
+        job.run()
+        self.assertEqual(sorted(paths[:-1]), sorted(trashed))
+        self.assertEqual([('bad', 'Permission denied')], job.errors)
+        self.assertEqual(100, job.files)
+
+class DirSizeTest(FileTestCase):
+
+    def test_size(self):
+        write_file(os.path.join(self.src, 'a'), b'12345')
+        os.makedirs(os.path.join(self.src, 'b', 'c'))
+        write_file(os.path.join(self.src, 'b', 'c', 'd'), b'123')
+        os.link(os.path.join(self.src, 'a'), os.path.join(self.src, 'b', 'e'))
+        write_file(os.path.join(self.dst, 'f'), b'1')
+        job = DirSizeJob([self.src, self.dst, os.path.join(self.dst, 'f')])
+        job.run()
+        self.assertEqual([], job.errors)
+        self.assertEqual([8, 1, 1], job.sizes)
+        self.assertEqual(4, job.files)
+        self.assertEqual(10, job.bytes)
+
+    def test_cache(self):
+        write_file(os.path.join(self.src, 'a'), b'12345')
+        job = DirSizeJob([self.src])
+        job.run()
+        self.assertEqual([5], job.sizes)
+        # A file growing in place doesn't change the directory.
+        with open(os.path.join(self.src, 'a'), 'ab') as f:
+            f.write(b'6')
+        job = DirSizeJob([self.src])
+        job.run()
+        self.assertEqual([6], job.sizes)
+        write_file(os.path.join(self.src, 'b'), b'1')
+        os.utime(self.src, (0, 1))
+        job = DirSizeJob([self.src])
+        job.run()
+        self.assertEqual([7], job.sizes)
+        self.assertEqual(2, job.files)
+
+class CompareTest(FileTestCase):
+
+    def compare(self):
+        cache = HashCache(os.path.join(self.dir, 'cache', 'hashes'))
+        reported = []
+        job = CompareJob(self.src, self.dst, workers=2, cache=cache)
+        job.on_result = lambda job, path, result: reported.append(path)
+        job.run()
+        self.assertEqual([], job.errors)
+        self.assertEqual(sorted(reported), sorted(p for p, r in job.results))
+        return dict(job.results)
+
+    def test_hash_file(self):
+        path = os.path.join(self.src, 'a')
+        write_file(path, b'')
+        self.assertEqual('da39a3ee5e6b4b0d3255bfef95601890afd80709',
+            hash_file(path))
+        write_file(path, b'abc')
+        self.assertEqual('a9993e364706816aba3e25717850c26c9cd0d89d',
+            hash_file(path))
+
+    def test_compare(self):
+        self.make_tree(os.path.join(self.src, 'tree'))
+        self.make_tree(os.path.join(self.dst, 'tree'))
+        write_file(os.path.join(self.src, 'left'), b'')
+        write_file(os.path.join(self.dst, 'right'), b'')
+        # Same size and different contents.
+        write_file(os.path.join(self.src, 'tree', 'sub', '1'), b'x')
+        os.utime(os.path.join(self.dst, 'tree', 'sub', '2'), (0, 0))
+        os.remove(os.path.join(self.dst, 'tree', 'link'))
+        os.symlink('large', os.path.join(self.dst, 'tree', 'link'))
+        self.assertEqual({
+            'left': nemo_ops.LEFT_ONLY,
+            'right': nemo_ops.RIGHT_ONLY,
+            os.path.join('tree', 'link'): nemo_ops.DIFFERENT,
+            os.path.join('tree', 'sub', '1'): nemo_ops.DIFFERENT
+        }, self.compare())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, 'cache', 'hashes')))
+
+    def test_hash_cache(self):
+        path = os.path.join(self.src, 'a')
+        write_file(path, b'abc')
+        filename = os.path.join(self.dir, 'hashes')
+        cache = HashCache(filename)
+        h = cache.get_hash(path, os.stat(path))
+        cache.save()
+        cache = HashCache(filename)
+        st = os.stat(path)
+        os.remove(path)
+        # The file is not read because the hash is cached.
+        self.assertEqual(h, cache.get_hash(path, st))
+
+class SyncTest(FileTestCase):
+
+    def sync(self):
+        job = SyncJob(os.path.join(self.src, 'tree'),
+                      os.path.join(self.dst, 'tree'), workers=2)
+        job.run()
+        self.assertEqual([], job.errors)
+        return job
+
+    def test_sync_new_tree(self):
+        self.make_tree(os.path.join(self.src, 'tree'))
+        job = self.sync()
+        self.assertSameTree(self.src, self.dst)
+        self.assertEqual(104, job.counts[nemo_ops.NEW])
+
+    def test_sync(self):
+        src = os.path.join(self.src, 'tree')
+        dst = os.path.join(self.dst, 'tree')
+        self.make_tree(src)
+        shutil.copytree(src, dst, symlinks=True)
+        write_file(os.path.join(src, 'new'), b'new')
+        write_file(os.path.join(src, 'sub', '1'), b'changed')
+        write_file(os.path.join(dst, 'deleted'), b'')
+        os.remove(os.path.join(src, 'link'))
+        os.mkdir(os.path.join(src, 'link'))
+        self.assertEqual([
+            (nemo_ops.DELETED, 'link'), (nemo_ops.NEW, 'link'),
+            (nemo_ops.NEW, 'new'), (nemo_ops.DELETED, 'deleted'),
+            (nemo_ops.CHANGED, os.path.join('sub', '1'))
+        ], [(action, path) for action, path, st in plan_sync(src, dst)])
+        job = self.sync()
+        self.assertSameTree(self.src, self.dst)
+        self.assertEqual({nemo_ops.NEW: 2, nemo_ops.CHANGED: 1,
+                          nemo_ops.DELETED: 2}, job.counts)
+        self.assertEqual([], list(plan_sync(src, dst)))
+
+    def assertNestedRejected(self, source, target):
+        job = SyncJob(source, target, workers=2)
+        job.run()
+        self.assertEqual(1, len(job.errors))
+        self.assertEqual(target, job.errors[0][0])
+
+    def test_sync_into_subdirectory(self):
+        self.make_tree(os.path.join(self.src, 'tree'))
+        target = os.path.join(self.src, 'tree', 'sub')
+        self.assertNestedRejected(os.path.join(self.src, 'tree'), target)
+        self.assertEqual(100, len(os.listdir(target)))
+
+    def test_sync_into_parent(self):
+        self.make_tree(os.path.join(self.src, 'tree'))
+        source = os.path.join(self.src, 'tree', 'sub')
+        self.assertNestedRejected(source, os.path.join(self.src, 'tree'))
+        self.assertEqual(100, len(os.listdir(source)))
+
+    def test_update_file(self):
+        block_size = nemo_ops.DELTA_BLOCK_SIZE
+        src = os.path.join(self.src, 'a')
+        dst = os.path.join(self.dst, 'a')
+        data = bytearray(b'x' * (block_size * 3))
+        write_file(dst, bytes(data) + b'tail')
+        data[block_size + 1] = ord('y')
+        write_file(src, bytes(data))
+        self.assertEqual(block_size, update_file(src, dst))
+        self.assertEqual(read_file(src), read_file(dst))
+
+class FindTest(FileTestCase):
+
+    def find(self, pattern, index=None):
+        job = FindJob(self.src, pattern, index, workers=2)
+        removed = []
+        job.on_removed = lambda job, path: removed.append(path)
+        job.run()
+        self.assertEqual([], job.errors)
+        return sorted(job.results), removed
+
+    def test_find(self):
+        self.make_tree(os.path.join(self.src, 'tree'))
+        self.assertEqual([os.path.join('tree', 'large')],
+                         self.find('LAR')[0])
+        self.assertEqual(sorted(os.path.join('tree', 'sub', str(i))
+                                for i in range(10, 20)),
+                         self.find('1?')[0])
+
+    def test_index(self):
+        self.make_tree(os.path.join(self.src, 'tree'))
+        index = FileIndex(self.src, os.path.join(self.dir, 'index'))
+        self.find('sma', index)
+        self.assertTrue(index.fresh)
+        # A fresh index answers without crawling the tree.
+        shutil.rmtree(os.path.join(self.src, 'tree'))
+        self.assertEqual(['tree/small'], self.find('sma', index)[0])
+        # A saved index is refreshed by a crawl.
+        index = FileIndex(self.src, os.path.join(self.dir, 'index'))
+        self.assertFalse(index.is_empty())
+        self.assertEqual(([], ['tree/small']), self.find('sma', index))
+        self.assertEqual([''], index.get_dirs())
+
+    def test_index_non_ascii_root(self):
+        name = u'caf\xe9'
+        if bytes == str:
+            # Python 2 passes paths as UTF-8 encoded byte strings.
+            name = name.encode('utf-8')
+        roots = [os.path.join(self.src, name)]
+        if hasattr(os, 'fsdecode'):
+            # A name that is not valid UTF-8.
+            roots.append(os.path.join(self.src, os.fsdecode(b'\xff')))
+        for root in roots:
+            os.mkdir(root)
+            write_file(os.path.join(root, 'a'), b'')
+            index = FileIndex(root)
+            index.filename = os.path.join(self.dir, 'index')
+            job = FindJob(root, 'a', index, workers=2)
+            job.run()
+            self.assertEqual([], job.errors)
+            self.assertEqual({'a'}, job.results)
+            index = FileIndex(root, os.path.join(self.dir, 'index'))
+            self.assertEqual([''], index.get_dirs())
+
+    def test_index_updates(self):
+        os.makedirs(os.path.join(self.src, 'a', 'b'))
+        index = FileIndex(self.src, os.path.join(self.dir, 'index'))
+        self.find('x', index)
+        index.add(os.path.join('a', 'b', 'x'), False)
+        index.add(os.path.join('a', 'c'), True)
+        index.add(os.path.join('a', 'c', 'x'), True)
+        self.assertEqual(['a/b/x', 'a/c/x'], self.find('x', index)[0])
+        index.remove('a')
+        self.assertEqual([''], index.get_dirs())
+        self.assertEqual([], self.find('x', index)[0])
+
+if __name__ == '__main__':
+    unittest.main()